@@ -2,6 +2,9 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 # SPDX-FileName: data_types.py
 
+import io
+from functools import lru_cache
+
 invalid_chars = [
 	" ",  # ue4 doesn't like spaces in filenames, better just reject them everywhere
 	".",
@@ -36,6 +39,9 @@ invalid_chars = [
 ]
 
 
+# the same names get sanitized many times during an export (meshes, materials, instances)
+# the cache is bounded, and cleared after each export, so it doesn't grow during a session
+@lru_cache(maxsize=4096)
 def sanitize_name(name):
 	output = name
 	for invalid_char in invalid_chars:
@@ -65,31 +71,43 @@ class Node:
 		self.attrs[key] = value
 
 	def string_rep(self, first=False):
+		output = io.StringIO()
+		self.write_to(output, first)
+		return output.getvalue()
+
+	# writes the same output as string_rep, without building the whole string
+	def write_to(self, fp, first=False):
+		write = fp.write
 		previous_prefix = Node.prefix
 		if first:
 			Node.prefix = ""
 		else:
 			Node.prefix += "\t"
-		output = Node.prefix + "<{}".format(self.name)
+		write(Node.prefix + "<" + self.name)
 		if first:
 			Node.prefix = "\n"
 		for attr in self.attrs:
-			output += ' {key}="{value}"'.format(key=attr, value=self.attrs[attr])
+			write(' {key}="{value}"'.format(key=attr, value=self.attrs[attr]))
 
 		if self.children:
-			output += ">"
+			write(">")
 			for child in self.children:
-				output += str(child)
+				# preformatted children (like expression inputs) are the most common
+				if type(child) is str:
+					write(child)
+				elif isinstance(child, Node):
+					child.write_to(fp)
+				else:
+					write(str(child))
 			if len(self.children) == 1 and type(self.children[0]) is str:
 				# TODO: instead of doing this, I think it would be nice to allow children
 				# to be a string, because that is when we're interested in inlining
-				output += "</{}>".format(self.name)
+				write("</{}>".format(self.name))
 			else:
-				output += Node.prefix + "</{}>".format(self.name)
+				write(Node.prefix + "</{}>".format(self.name))
 		else:
-			output += "/>"
+			write("/>")
 		Node.prefix = previous_prefix
-		return output
 
 	def __str__(self):
 		return self.string_rep()
@@ -2,39 +2,58 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 # SPDX-FileName: export_datasmith.py
 
+import io
 import logging
 import math
 import numpy as np
 import os
-import shutil
 import struct
 import time
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha1
+from itertools import repeat
 from os import path
 
 import bpy
-import bmesh
-from mathutils import Matrix
+from mathutils import Euler, Matrix, Quaternion
 
 from .data_types import Node, sanitize_name
 from .export_material import collect_all_materials, get_texture_name
 
+try:
+	from hashlib import file_digest
+except ImportError:  # python < 3.11
+	file_digest = None
+
+try:
+	from bpy_extras.anim_utils import action_get_channelbag_for_slot
+except ImportError:  # blender < 4.4
+	action_get_channelbag_for_slot = None
+
 
 log = logging.getLogger("bl_datasmith")
 
 
 def calc_hash(image_path):
-	result = sha1()
 	with open(image_path, "rb") as f:
-		buf = f.read(524288)  # read 512KB
-		while len(buf) > 0:
-			result.update(buf)
-			buf = f.read(524288)
+		if file_digest:
+			return file_digest(f, sha1).hexdigest()
+
+		result = sha1()
+		buf = bytearray(1 << 20)  # read 1MB at a time
+		view = memoryview(buf)
+		num_read = f.readinto(buf)
+		while num_read:
+			result.update(view[:num_read])
+			num_read = f.readinto(buf)
 	return result.hexdigest()
 
 
 matrix_datasmith = Matrix.Scale(100, 4)
 matrix_datasmith[1][1] *= -1.0
+matrix_datasmith.freeze()
+matrix_datasmith_inv = matrix_datasmith.inverted()
+matrix_datasmith_inv.freeze()
 
 
 # used for lights and cameras, whose forward is (0, 0, -1) and its right is (1, 0, 0)
@@ -46,6 +65,7 @@ matrix_forward = Matrix(
 		(0, 0, 0, 1),
 	)
 )
+matrix_forward.freeze()
 
 
 log = logging.getLogger("bl_datasmith")
@@ -54,7 +74,8 @@ log = logging.getLogger("bl_datasmith")
 def write_array_data(io, data):
 	assert isinstance(data, np.ndarray)
 	io.write(struct.pack("<I", len(data)))
-	data.tofile(io)
+	# write straight from the array memory, without an intermediate bytes copy
+	io.write(memoryview(np.ascontiguousarray(data)).cast("B"))
 
 
 def write_data(io, data_struct, *args):
@@ -63,8 +84,15 @@ def write_data(io, data_struct, *args):
 	io.write(packed)
 
 
+# slicing a memoryview doesn't copy, unlike slicing bytes
+null_bytes = memoryview(bytes(64))
+
+
 def write_null(io, num_bytes):
-	io.write(b"\0" * num_bytes)
+	if num_bytes <= len(null_bytes):
+		io.write(null_bytes[:num_bytes])
+	else:
+		io.write(bytes(num_bytes))
 
 
 def write_string(io, string):
@@ -80,9 +108,13 @@ def mesh_save(mesh, basedir, folder_name):
 
 	relative_path = path.join(folder_name, mesh_name + ".udsmesh")
 	abs_path = path.join(basedir, relative_path)
+	# build the file in memory so we can hash it without reading it back
+	buffer = io.BytesIO()
+	write_to_path(mesh_name, data, buffer)
+	mesh_bytes = buffer.getbuffer()
+	mesh_hash = sha1(mesh_bytes).hexdigest()
 	with open(abs_path, "wb") as file:
-		write_to_path(mesh_name, data, file)
-	mesh_hash = calc_hash(abs_path)
+		file.write(mesh_bytes)
 
 	n = Node("StaticMesh")
 	name, materials, _ = mesh
@@ -178,19 +210,46 @@ def collect_mesh(name, bl_mesh):
 	meshes[name] = (name, materials, mesh_data)
 
 
+# reusable buffers for the temporary per mesh arrays, so we don't allocate
+# them again for every mesh. the arrays we keep are still allocated per mesh
+scratch_buffers = {}
+
+
+def get_scratch_buffer(key, size, dtype):
+	buffer = scratch_buffers.get(key)
+	if buffer is None or len(buffer) < size:
+		buffer = scratch_buffers[key] = np.empty(size, dtype)
+	return buffer[:size]
+
+
+# written instead of invalid normals
+default_normal = np.array((0, 0, 1), np.float32)
+
+
 def make_mesh_data(bl_mesh):
 	# create copy to triangulate
 	m = bl_mesh.copy()
 
-	# triangulate with bmesh api
-	bm = bmesh.new()
-	bm.from_mesh(m)
-	bmesh.ops.triangulate(bm, faces=bm.faces[:])
+	polygons = m.polygons
+	polygon_sizes = np.empty(len(polygons), np.uint32)
+	polygons.foreach_get("loop_total", polygon_sizes)
 
-	bm.loops.layers.uv.verify()  # this ensures that an UV layer exists
+	if np.all(polygon_sizes == 3):
+		# already triangulated, no need for the bmesh round trip
+		if not m.uv_layers:
+			m.uv_layers.new()
+	else:
+		# triangulate with bmesh api, only imported when a mesh needs it
+		import bmesh
 
-	bm.to_mesh(m)
-	bm.free()
+		bm = bmesh.new()
+		bm.from_mesh(m)
+		bmesh.ops.triangulate(bm, faces=bm.faces[:])
+
+		bm.loops.layers.uv.verify()  # this ensures that an UV layer exists
+
+		bm.to_mesh(m)
+		bm.free()
 
 	m.transform(matrix_datasmith)
 
@@ -214,54 +273,65 @@ def make_mesh_data(bl_mesh):
 	material_slots = np.empty(num_triangles, np.uint32)
 	loop_triangles.foreach_get("material_index", material_slots)
 
-	normals = np.empty(num_loops * 3, np.float32)
-	loop_triangles.foreach_get("split_normals", normals)
-	normals = normals.reshape((-1, 3))
-	normals *= -1
+	# the mesh is triangulated, so every triangle maps to three loops and we
+	# can read the normals per loop, instead of the per triangle split_normals
+	loop_indices = get_scratch_buffer("loop_indices", num_loops, np.uint32)
+	loop_triangles.foreach_get("loops", loop_indices)
+
+	normals = get_scratch_buffer("loop_normals", len(m.loops) * 3, "<f4")
+	if hasattr(m, "corner_normals"):  # blender 4.1+
+		m.corner_normals.foreach_get("vector", normals)
+	else:
+		m.calc_normals_split()
+		m.loops.foreach_get("normal", normals)
+	# gathering gives us a new contiguous buffer we can negate in place
+	normals = normals.reshape((-1, 3))[loop_indices]
+	np.negative(normals, out=normals)
 
 	# in case vert has invalid normals, put some dummy data so UE doesn't try to recalculate
-	normals_drift = np.linalg.norm(normals, axis=1) - 1
-	normals_faulty = np.abs(normals_drift) > 0.008
-	normals[normals_faulty] = (0, 0, 1)
-	out_normals = np.ascontiguousarray(normals, "<f4")
+	# compare squared lengths against squared bounds to skip the sqrt
+	normals_sq_length = np.einsum("ij,ij->i", normals, normals)
+	normals_faulty = (normals_sq_length < 0.992**2) | (normals_sq_length > 1.008**2)
+	np.copyto(normals, default_normal, where=normals_faulty[:, None])
+	out_normals = normals
 
 	# finish inline mesh_copy_triangulate
 	# smoothing_groups = m.calc_smooth_groups()[0]
 	# smoothing_groups = np.array(smoothing_groups, np.uint32)
 	smoothing_groups = np.zeros(num_triangles, np.uint32)
 
-	uvs = []
 	num_uvs = min(8, len(m.uv_layers))
 	active_uv = 0
 	for idx in range(num_uvs):
 		if m.uv_layers[idx].active_render:
 			active_uv = idx
-	for idx in range(num_uvs):
-		uv_idx = idx  # swap active_render UV with channel 0
-		if uv_idx == 0:
-			uv_idx = active_uv
-		elif uv_idx == active_uv:
-			uv_idx = 0
-
-		uv_data = m.uv_layers[uv_idx].data
-		uv_loops = np.empty(len(uv_data) * 2, np.float32)
-		uv_data.foreach_get("uv", uv_loops)
-		uv_loops = uv_loops.reshape((-1, 2))
-
-		uv_channel = uv_loops
-		uv_channel[:, 1] = 1 - uv_channel[:, 1]
-		uvs.append(uv_channel)
+	# swap active_render UV with channel 0
+	uv_order = list(range(num_uvs))
+	if active_uv:
+		uv_order[0], uv_order[active_uv] = uv_order[active_uv], uv_order[0]
+	# all channels share one buffer, so V can be flipped in a single pass
+	uvs_buffer = np.empty((num_uvs, len(m.loops), 2), np.float32)
+	for channel_idx, uv_idx in enumerate(uv_order):
+		m.uv_layers[uv_idx].data.foreach_get("uv", uvs_buffer[channel_idx].reshape(-1))
+	uvs_v = uvs_buffer[:, :, 1]
+	np.subtract(1, uvs_v, out=uvs_v)
+	uvs = list(uvs_buffer)
 
 	out_vertex_colors = None
 	if m.vertex_colors:
-		vertex_colors = np.empty(num_loops * 4)
+		vertex_colors = get_scratch_buffer("vertex_colors", num_loops * 4, np.float32)
 		m.vertex_colors[0].data.foreach_get("color", vertex_colors)
-		vertex_colors *= 255
-		vertex_colors = vertex_colors.reshape((-1, 4))
-		vertex_colors[:, [0, 2]] = vertex_colors[:, [2, 0]]
-		out_vertex_colors = vertex_colors.astype(np.uint8)
+		np.multiply(vertex_colors, 255, out=vertex_colors)
+		# clamp first, out of range values don't convert well to bytes
+		np.clip(vertex_colors, 0, 255, out=vertex_colors)
+		out_vertex_colors = np.empty((num_loops, 4), np.uint8)
+		out_vertex_colors.reshape(-1)[:] = vertex_colors
+		# swap R and B on the narrow buffer, through a single column copy
+		red = out_vertex_colors[:, 0].copy()
+		out_vertex_colors[:, 0] = out_vertex_colors[:, 2]
+		out_vertex_colors[:, 2] = red
 	else:
-		out_vertex_colors = np.zeros(0)
+		out_vertex_colors = np.zeros(0, np.uint8)
 	bpy.data.meshes.remove(m)
 
 	return (material_slots, smoothing_groups, positions, indices, out_normals, uvs, out_vertex_colors)
@@ -269,7 +339,7 @@ def make_mesh_data(bl_mesh):
 
 def collect_object_transform(bl_obj, instance_matrix=None):
 	mat_basis = instance_matrix or bl_obj.matrix_world
-	obj_mat = matrix_datasmith @ mat_basis @ matrix_datasmith.inverted()
+	obj_mat = matrix_datasmith @ mat_basis @ matrix_datasmith_inv
 
 	if bl_obj.type in "CAMERA" or bl_obj.type == "LIGHT":
 		obj_mat = obj_mat @ matrix_forward
@@ -401,13 +471,20 @@ def save_texture(texture, basedir, folder_name, skip_textures):
 
 	# fix for invalid images, like one in mr_elephant sample.
 	valid_image = image.channels != 0
+	img_hash = None
 	if valid_image and not skip_image:
 		source_path = image.filepath_from_user()
 
 		if image.packed_file:
+			# we already have the data in memory, so hash it from there
+			packed_data = image.packed_file.data
 			with open(image_path, "wb") as f:
-				f.write(image.packed_file.data)
+				f.write(packed_data)
+			img_hash = sha1(packed_data).hexdigest()
 		elif source_path and source_path != image_path:
+			# copyfile already uses the fastest copy the OS offers
+			import shutil
+
 			shutil.copyfile(source_path, image_path)
 		else:
 			image.filepath_raw = image_path
@@ -434,7 +511,8 @@ def save_texture(texture, basedir, folder_name, skip_textures):
 
 	n["texturefilter"] = "3"
 	if valid_image:
-		img_hash = calc_hash(image_path)
+		if not img_hash:
+			img_hash = calc_hash(image_path)
 		n.push(Node("Hash", {"value": img_hash}))
 	return n
 
@@ -464,12 +542,13 @@ def get_mesh_name(bl_obj_inst):
 			try_count = 0
 
 			# just to reaaally make sure there are no collisions
-			libraries_prefixes = libraries_dict.values()
-			while prefix in libraries_prefixes:
+			library_prefixes = datasmith_context["library_prefixes"]
+			while prefix in library_prefixes:
 				try_count += 1
 				prefix = "%s%d_" % (base_prefix, try_count)
 
 			libraries_dict[library] = prefix
+			library_prefixes.add(prefix)
 
 		bl_mesh_name = prefix + bl_mesh_name
 
@@ -525,6 +604,10 @@ def fill_obj_mesh(obj_dict, bl_obj):
 				fields.append('\t<material id="%i" name="%s"/>\n' % (idx, safe_name))
 
 
+# spot_size is the full cone angle in radians, datasmith wants half of it in degrees
+SPOT_SIZE_TO_CONE_ANGLE = 180 / (2 * math.pi)
+
+
 def fill_obj_light(obj_dict, target):
 	obj_dict["type"] = "Light"
 
@@ -533,7 +616,6 @@ def fill_obj_light(obj_dict, target):
 
 	bl_light = target.data
 	light_intensity = bl_light.energy
-	light_attenuation_radius = 100 * math.sqrt(bl_light.energy)
 	light_color = bl_light.color
 	light_intensity_units = "Lumens"  # can also be 'Candelas' or 'Unitless'
 	light_use_custom_distance = bl_light.use_custom_distance
@@ -546,7 +628,7 @@ def fill_obj_light(obj_dict, target):
 
 	elif bl_light.type == "SPOT":
 		light_type = "SpotLight"
-		outer_cone_angle = bl_light.spot_size * 180 / (2 * math.pi)
+		outer_cone_angle = bl_light.spot_size * SPOT_SIZE_TO_CONE_ANGLE
 		inner_cone_angle = outer_cone_angle * (1 - bl_light.spot_blend)
 		if inner_cone_angle < 0.0001:
 			inner_cone_angle = 0.0001
@@ -577,6 +659,8 @@ def fill_obj_light(obj_dict, target):
 
 	if light_use_custom_distance:
 		light_attenuation_radius = 100 * bl_light.cutoff_distance
+	else:
+		light_attenuation_radius = 100 * math.sqrt(bl_light.energy)
 	# TODO: check how lights work when using a node tree
 	# if bl_light.use_nodes and bl_light.node_tree:
 
@@ -585,13 +669,18 @@ def fill_obj_light(obj_dict, target):
 	# 	light_intensity = node.inputs['Strength'].default_value # have to check how to relate to candelas
 	# 	log.error("unsupported: using nodetree for light " + bl_obj.name)
 	shadow_soft_size = bl_light.shadow_soft_size * 100
-	fields.append('\t<SourceSize value="%f"/>\n' % shadow_soft_size)
-
-	fields.append('\t<Intensity value="%f"/>\n' % light_intensity)
-	fields.append('\t<AttenuationRadius value="%f"/>\n' % light_attenuation_radius)
-	fields.append('\t<IntensityUnits value="%s"/>\n' % light_intensity_units)
-	# we could set usetemp=1 and write temperature attribute
-	fields.append('\t<Color usetemp="0" R="%f" G="%f" B="%f"/>\n' % light_color[:])
+	r, g, b = light_color
+	# fields are written one per line, as render_tree indents each one
+	fields.extend(
+		(
+			'\t<SourceSize value="%f"/>\n' % shadow_soft_size,
+			'\t<Intensity value="%f"/>\n' % light_intensity,
+			'\t<AttenuationRadius value="%f"/>\n' % light_attenuation_radius,
+			'\t<IntensityUnits value="%s"/>\n' % light_intensity_units,
+			# we could set usetemp=1 and write temperature attribute
+			'\t<Color usetemp="0" R="%f" G="%f" B="%f"/>\n' % (r, g, b),
+		)
+	)
 
 
 def fill_obj_camera(obj_dict, target):
@@ -694,31 +783,160 @@ obj_fill_funcs = {
 }
 
 
-def collect_object_transform2(bl_obj, instance_mat=None):
+transform_format = '\t<Transform tx="%f" ty="%f" tz="%f" qw="%f" qx="%f" qy="%f" qz="%f" sx="%f" sy="%f" sz="%f"/>\n'
+
+# numpy versions of the conversion matrices, frozen matrices can't be read
+# by numpy so we read from copies. the math is done in float32 like mathutils
+# does, so the results are the same as with Matrix.decompose
+matrix_datasmith_np = np.array(matrix_datasmith.copy(), np.float32)
+matrix_datasmith_inv_np = np.array(matrix_datasmith_inv.copy(), np.float32)
+matrix_forward_np = np.array(matrix_forward.copy(), np.float32)
+identity_matrix_np = np.identity(4, np.float32)
+
+
+# transforms are converted in a batch by write_pending_transforms, which
+# writes the resulting <Transform> tag to `target[key]`.
+# the queue can't keep bl_obj around, as dupli objects are temporary and
+# get reused for every instance, so the matrix applied after converting
+# to datasmith space (if any) is worked out here
+def queue_object_transform(target, key, bl_obj, instance_mat=None):
 	mat_basis = bl_obj.matrix_world
 	if instance_mat:
 		mat_basis = instance_mat
-	obj_mat = matrix_datasmith @ mat_basis @ matrix_datasmith.inverted()
 
-	if bl_obj.type in "CAMERA" or bl_obj.type == "LIGHT":
-		obj_mat = obj_mat @ matrix_forward
-	elif bl_obj.type == "LIGHT_PROBE":
+	post_matrix = None
+	obj_type = bl_obj.type
+	if obj_type == "CAMERA" or obj_type == "LIGHT":
+		post_matrix = matrix_forward_np
+	elif obj_type == "LIGHT_PROBE":
 		bl_probe = bl_obj.data
 		if bl_probe.type == "PLANAR":
-			obj_mat = obj_mat @ Matrix.Scale(0.05, 4)
+			post_matrix = np.array(Matrix.Scale(0.05, 4), np.float32)
 		elif bl_probe.type == "CUBEMAP":
 			if bl_probe.influence_type == "BOX":
 				size = bl_probe.influence_distance * 100
-				obj_mat = obj_mat @ Matrix.Scale(size, 4)
+				post_matrix = np.array(Matrix.Scale(size, 4), np.float32)
+
+	datasmith_context["pending_transforms"].append((target, key, mat_basis.copy(), post_matrix))
+
+
+# normalizes the columns of (N, 3, 3) matrices in place, returns their lengths
+def normalize_columns(mats):
+	lengths_sq = mats[:, 0] * mats[:, 0] + mats[:, 1] * mats[:, 1] + mats[:, 2] * mats[:, 2]
+	valid = lengths_sq > 1e-35
+	lengths = np.zeros_like(lengths_sq)
+	lengths[valid] = np.sqrt(lengths_sq[valid])
+	inv_lengths = np.zeros_like(lengths_sq)
+	inv_lengths[valid] = 1 / lengths[valid]
+	mats *= inv_lengths[:, None, :]
+	return lengths
+
+
+# converts (N, 3, 3) rotation matrices to (N, 4) quaternions as (w, x, y, z),
+# solving first for the biggest component and keeping w positive, like mathutils
+def rotations_to_quats(rots):
+	r00, r01, r02, r10, r11, r12, r20, r21, r22 = rots.reshape((-1, 9)).T
+
+	use_x = (r22 < 0) & (r00 > r11)
+	use_y = (r22 < 0) & ~use_x
+	use_z = (r22 >= 0) & (r00 < -r11)
+	use_w = (r22 >= 0) & ~use_z
+	conditions = (use_x, use_y, use_z)
+
+	diff_x = r21 - r12
+	diff_y = r02 - r20
+	diff_z = r10 - r01
+	sum_xy = r10 + r01
+	sum_xz = r02 + r20
+	sum_yz = r21 + r12
+
+	traces = np.select(
+		conditions,
+		(1 + r00 - r11 - r22, 1 - r00 + r11 - r22, 1 - r00 - r11 + r22),
+		1 + r00 + r11 + r22,
+	)
+	s = 2 * np.sqrt(np.maximum(traces, 0))
+	s[np.select(conditions, (diff_x, diff_y, diff_z), 0) < 0] *= -1
+	quarter = 0.25 * s
+	inv_s = 1 / s
+
+	quats = np.empty((len(rots), 4), np.float32)
+	quats[:, 0] = np.select(conditions, (diff_x, diff_y, diff_z), 0) * inv_s
+	quats[:, 1] = np.select((use_y, use_z, use_w), (sum_xy, sum_xz, diff_x), 0) * inv_s
+	quats[:, 2] = np.select((use_x, use_z, use_w), (sum_xy, sum_yz, diff_y), 0) * inv_s
+	quats[:, 3] = np.select((use_x, use_y, use_w), (sum_xz, sum_yz, diff_z), 0) * inv_s
+	quats[use_w, 0] = quarter[use_w]
+	quats[use_x, 1] = quarter[use_x]
+	quats[use_y, 2] = quarter[use_y]
+	quats[use_z, 3] = quarter[use_z]
+
+	q0, q1, q2, q3 = quats.T
+	quats *= (1 / np.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3))[:, None]
+	return quats
+
+
+# converts (N, 3, 3) rotation matrices to (N, 3) XYZ euler angles, picking
+# the smallest of the two possible solutions, like mathutils
+def rotations_to_eulers(rots):
+	r00, r01, r02, r10, r11, r12, r20, r21, r22 = rots.reshape((-1, 9)).T
+
+	cy = np.hypot(r00, r10)
+	eul1 = np.stack((np.arctan2(r21, r22), np.arctan2(-r20, cy), np.arctan2(r10, r00)), axis=1)
+	eul2 = np.stack((np.arctan2(-r21, -r22), np.arctan2(-r20, -cy), np.arctan2(-r10, -r00)), axis=1)
+
+	gimbal_lock = cy <= 16 * np.finfo(np.float32).eps
+	eul1[gimbal_lock, 0] = np.arctan2(-r12, r11)[gimbal_lock]
+	eul1[gimbal_lock, 2] = 0
+	eul2[gimbal_lock] = eul1[gimbal_lock]
+
+	use_eul2 = np.abs(eul2).sum(axis=1) < np.abs(eul1).sum(axis=1)
+	eul1[use_eul2] = eul2[use_eul2]
+	return eul1
+
+
+# decomposes (N, 4, 4) matrices the same way as Matrix.decompose, but
+# returns the rotations as (N, 3, 3) matrices
+def decompose_matrices(matrices):
+	locs = matrices[:, :3, 3]
+	rots = matrices[:, :3, :3].copy()
+	scales = normalize_columns(rots)
+	# only the sign of the determinant matters, the triple product of the
+	# columns is much cheaper than np.linalg.det on small matrices
+	negative = np.einsum("ni,ni->n", rots[:, :, 0], np.cross(rots[:, :, 1], rots[:, :, 2])) < 0
+	rots[negative] *= -1
+	scales[negative] *= -1
+	normalize_columns(rots)
+	return locs, rots, scales
+
+
+def write_pending_transforms(pending_transforms):
+	if not pending_transforms:
+		return
 
-	loc, rot, scale = obj_mat.decompose()
-	return '\t<Transform tx="%f" ty="%f" tz="%f" qw="%f" qx="%f" qy="%f" qz="%f" sx="%f" sy="%f" sz="%f"/>\n' % (loc.x, loc.y, loc.z, rot.w, rot.x, rot.y, rot.z, scale.x, scale.y, scale.z)
+	matrices = np.array([matrix for _, _, matrix, _ in pending_transforms], np.float32).reshape((-1, 4, 4))
+	matrices = matrix_datasmith_np @ matrices @ matrix_datasmith_inv_np
+
+	post_matrices = [post_matrix for _, _, _, post_matrix in pending_transforms]
+	use_forward = np.array([post_matrix is matrix_forward_np for post_matrix in post_matrices], dtype=bool)
+	matrices[use_forward] = matrices[use_forward] @ matrix_forward_np
+
+	for idx, post_matrix in enumerate(post_matrices):
+		if post_matrix is not None and post_matrix is not matrix_forward_np:
+			matrices[idx] = matrices[idx] @ post_matrix
+
+	locs, rots, scales = decompose_matrices(matrices)
+	quats = rotations_to_quats(rots)
+
+	values = np.concatenate((locs, quats, scales), axis=1).tolist()
+	for (target, key, _, _), transform_values in zip(pending_transforms, values):
+		target[key] = transform_format % tuple(transform_values)
+	pending_transforms.clear()
 
 
 # ensures that `objects` has an entry for `_object` and ensures that
 # the parent is also already there, and has `_object` as a children
 # returns the base actor structure, as added in the `objects` list
-def get_object_data(objects, _object, top_level_objs, object_name=None, instance_parent=None):
+def get_object_data(objects, _object, top_level_objs, object_name=None, instance_parent=None, instance_matrix=None):
 	assert _object
 	unique = False
 	if object_name:
@@ -732,7 +950,7 @@ def get_object_data(objects, _object, top_level_objs, object_name=None, instance
 	if not unique:
 		object_data = objects.get(object_name)
 	if not object_data:
-		object_data = create_object(_object)
+		object_data = create_object(_object, instance_matrix)
 		object_data["name"] = object_name
 
 		if not unique:
@@ -748,7 +966,7 @@ def get_object_data(objects, _object, top_level_objs, object_name=None, instance
 	return object_data
 
 
-def create_object(obj):
+def create_object(obj, instance_matrix=None):
 	assert obj
 
 	visible = not obj.hide_render and obj.show_instancer_for_render
@@ -763,7 +981,7 @@ def create_object(obj):
 		if original.users_collection:
 			object_data["layer"] = sanitize_name(original.users_collection[0].name_full)
 
-	object_data["transform"] = collect_object_transform2(obj)
+	queue_object_transform(object_data, "transform", obj, instance_matrix)
 	return object_data
 
 
@@ -782,7 +1000,6 @@ def collect_depsgraph(output, use_instanced_meshes, selected_only):
 		if selected_only and not instance.object.original.select_get():
 			continue
 
-		transform = collect_object_transform2(instance.object, instance.matrix_world)
 		was_instanced = False
 		if use_instanced_meshes and instance.is_instance:
 			original = instance.instance_object.original
@@ -818,10 +1035,11 @@ def collect_depsgraph(output, use_instanced_meshes, selected_only):
 					parent_matrix = instance.parent.matrix_world
 					# instance_matrix = instance.matrix_world @ parent_matrix.inverted()
 					instance_matrix = parent_matrix.inverted() @ instance.matrix_world
-					instance_transform = collect_object_transform2(instance.object, instance_matrix)
-					instance_world_transform = collect_object_transform2(instance.object, instance.matrix_world)
-
-					instance_list.append((instance_transform, instance_world_transform, instance_material_slots))
+					# entries are (transform, world_transform, material_slots)
+					instance_entry = [None, None, instance_material_slots]
+					queue_object_transform(instance_entry, 0, instance.object, instance_matrix)
+					queue_object_transform(instance_entry, 1, instance.object, instance.matrix_world)
+					instance_list.append(instance_entry)
 
 		if not was_instanced:
 			obj = instance.object
@@ -829,36 +1047,31 @@ def collect_depsgraph(output, use_instanced_meshes, selected_only):
 			name = None
 
 			inst_parent = None
+			inst_matrix = None
 			if instance.is_instance:
 				inst_parent = instance.parent
+				inst_matrix = instance.matrix_world
 				name = make_instance_name(instance)
 
-			object_data = get_object_data(instance_groups, obj, top_level_objs, object_name=name, instance_parent=inst_parent)
-
-			if instance.is_instance:
-				object_data["transform"] = transform
+			# instances are created with their instance matrix, so their
+			# transform is only queued once
+			object_data = get_object_data(instance_groups, obj, top_level_objs, object_name=name, instance_parent=inst_parent, instance_matrix=inst_matrix)
 
 			filler = obj_fill_funcs.get(obj.type, fill_obj_unknown)
 			filler(object_data, obj)
 
-	output = []
+	write_pending_transforms(datasmith_context["pending_transforms"])
+
+	output = io.StringIO()
 	for parent_obj in top_level_objs:
 		render_tree(parent_obj, output, indent="\t")
 
-	result = "".join(output)
-	return result
+	return output.getvalue()
 
 
 def make_instance_name(instance):
-	id_list = []
-	for id in instance.persistent_id:
-		if id != 0x7FFFFFFF:
-			id_list.append("_%i" % id)
-		else:
-			id_list.append("_")
-
-	instance_id = "".join("_%i" % id for id in instance.persistent_id if id != 0x7FFFFFFF)
-	instance_id = "".join(id_list)
+	# unused id slots are 0x7FFFFFFF, we keep them as a bare separator
+	instance_id = "".join("_%i" % id if id != 0x7FFFFFFF else "_" for id in instance.persistent_id)
 	inst = instance.instance_object
 	parent_chain = []
 	parent = instance.parent
@@ -871,144 +1084,311 @@ def make_instance_name(instance):
 
 
 def render_tree(obj_dict, output, indent):
-	output.append(indent)
-	output.append("<")
+	write = output.write
 	obj_type = obj_dict.get("type", "Actor")
-	output.append(obj_type)
-	output.append(' name="')
 	obj_name = obj_dict["name"]
-	output.append(obj_name)
 
+	layer_attrib = ""
 	layer = obj_dict.get("layer")
 	if layer:
-		output.append('" layer="')
-		obj_layer = obj_dict["layer"]
-		output.append(obj_layer)
+		layer_attrib = ' layer="%s"' % layer
 
-	output.append('"')
-
-	attribs = obj_dict["attrib"]
-	if attribs:
-		for attr in attribs:
-			output.append(attr)
-
-	output.append(">\n")
+	attribs = "".join(obj_dict["attrib"])
+	write('%s<%s name="%s"%s%s>\n' % (indent, obj_type, obj_name, layer_attrib, attribs))
 
 	fields = obj_dict["fields"]
 	for field in fields:
-		output.append(indent)
-		output.append(field)
+		write(indent + field)
 
-	output.append(indent)
-	output.append(obj_dict["transform"])
+	write(indent + obj_dict["transform"])
 
 	children = obj_dict["children"]
 	parent_instances = obj_dict["instances"]
 
 	if children or parent_instances:
-		output.append(indent)
-		output.append("\t<children>\n")
-		# output.append('\t<children visible="')
-		# output.append(str(obj_dict['visible']))
-		# output.append('">\n')
+		write("%s\t<children>\n" % indent)
 
+		next_indent = "%s\t\t" % indent
 		for child in children:
-			next_indent = "%s\t\t" % indent
 			render_tree(child, output, next_indent)
 
 		for original, instances in parent_instances.items():
 			num_instances = len(instances)
 			if num_instances == 1:
-				output.append(indent)
-				output.append('\t\t<ActorMesh name="')
-				output.append(obj_name)
-				output.append("_")
-				output.append(original)
-				output.append('">\n')
-				output.append(indent)
-				output.append('\t\t\t<mesh name="')
-				output.append(original)
-				output.append('"/>\n')
-				output.append(indent)
-				output.append("\t\t")
-
-				transform = instances[0][1]
-				output.append(transform)
-
-				instance_materials = instances[0][2]
+				transform, world_transform, instance_materials = instances[0]
+				write('%s\t\t<ActorMesh name="%s_%s">\n%s\t\t\t<mesh name="%s"/>\n%s\t\t%s' % (indent, obj_name, original, indent, original, indent, world_transform))
+
 				if instance_materials:
 					for mat in instance_materials:
-						output.append(indent)
-						output.append(mat)
+						write(indent + mat)
 
-				output.append(indent)
-				output.append("\t\t</ActorMesh>\n")
+				write("%s\t\t</ActorMesh>\n" % indent)
 
 			else:
-				output.append(indent)
-				output.append('\t\t<ActorHierarchicalInstancedStaticMesh name="')
-				output.append(obj_name)
-				output.append("_")
-				output.append(original)
-				output.append('">\n')
-				output.append(indent)
-				output.append('\t\t\t<mesh name="')
-				output.append(original)
-				output.append('"/>\n')
-				output.append(indent)
-				output.append("\t\t\t")
-				output.append(obj_dict["transform"])
-				output.append(indent)
-				output.append('\t\t\t<Instances count="')
-				output.append(str(len(instances)))
-				output.append('">\n')
+				write(
+					'%s\t\t<ActorHierarchicalInstancedStaticMesh name="%s_%s">\n%s\t\t\t<mesh name="%s"/>\n%s\t\t\t%s%s\t\t\t<Instances count="%d">\n'
+					% (indent, obj_name, original, indent, original, indent, obj_dict["transform"], indent, num_instances)
+				)
 				for instance in instances:
-					output.append(indent)
-					output.append(instance[0])
+					write(indent + instance[0])
 
-				output.append(indent)
-				output.append("\t\t\t</Instances>\n")
-				output.append(indent)
-				output.append("\t\t</ActorHierarchicalInstancedStaticMesh>\n")
+				write("%s\t\t\t</Instances>\n%s\t\t</ActorHierarchicalInstancedStaticMesh>\n" % (indent, indent))
 
-		output.append(indent)
-		output.append("\t</children>\n")
+		write("%s\t</children>\n" % indent)
 
-	output.append(indent)
-	output.append("</")
-	output.append(obj_type)
-	output.append(">\n")
+	write("%s</%s>\n" % (indent, obj_type))
 
 
-def get_instance_local_matrix(instance):
-	instance_matrix = instance.matrix_world
-
+def get_instance_parent(instance):
 	# first try for instanced objects parent (instancer object)
-	parent = instance.parent
-
 	# if not found, try for hierarchy parent
-	if not parent:
-		parent = instance.object.parent
+	return instance.parent or instance.object.parent
+
+
+# converts (..., 4, 4) world matrices and the world matrices of their
+# parents to local matrices in datasmith space
+def to_datasmith_local(worlds, parent_worlds, use_forward):
+	local_matrices = np.linalg.inv(parent_worlds.astype(np.float64)) @ worlds
+	local_matrices = (matrix_datasmith_np @ local_matrices @ matrix_datasmith_inv_np).astype(np.float32)
+	local_matrices[use_forward] = local_matrices[use_forward] @ matrix_forward_np
+	return local_matrices
+
+
+# object properties that contribute to the local transform, the rest of the
+# fcurves in an action don't need to be sampled
+sampled_transform_paths = (
+	"location",
+	"rotation_euler",
+	"rotation_quaternion",
+	"scale",
+	"delta_location",
+	"delta_rotation_euler",
+	"delta_rotation_quaternion",
+	"delta_scale",
+)
 
-	if parent:
-		parent_matrix = parent.matrix_world
-		instance_matrix = parent_matrix.inverted() @ instance_matrix
+# how much an animation key can change between frames before we consider that
+# it animates: translation in centimeters, rotation in degrees, and scale
+anim_tolerance = np.array((1e-3, 1e-3, 1e-3, 1e-3, 1e-3, 1e-3, 1e-5, 1e-5, 1e-5), np.float32)
 
-	instance_matrix = matrix_datasmith @ instance_matrix @ matrix_datasmith.inverted()
+anim_key_format = '{"id":%d,"x":%f,"y":%f,"z":%f}'
 
-	object_type = instance.object.type
-	if object_type in ["CAMERA", "LIGHT"]:
-		instance_matrix = instance_matrix @ matrix_forward
 
-	return instance_matrix
+# formats a (N, 4) array of (frame, x, y, z) keys with a single % operation
+def format_anim_keys(keys):
+	return ",".join((anim_key_format,) * len(keys)) % tuple(keys.ravel().tolist())
+
+
+# returns the fcurves that animate the object from its action, or None if
+# we can't tell which ones they are. blender 4.4 actions have slots, each
+# with their own fcurves, and 5.0 removed the action.fcurves of older versions
+def get_action_fcurves(anim_data):
+	action = anim_data.action
+	if not action:
+		return ()
+	if not hasattr(anim_data, "action_slot"):
+		return action.fcurves
+	slot = anim_data.action_slot
+	if not slot:
+		return ()
+	if action_get_channelbag_for_slot is None:
+		return None
+	channelbag = action_get_channelbag_for_slot(action, slot)
+	if not channelbag:
+		return ()
+	return channelbag.fcurves
+
+
+def can_sample_fcurves(bl_obj):
+	# if the local transform only depends on the object's own action we can
+	# evaluate the fcurves directly instead of evaluating the depsgraph
+	if bl_obj.constraints or bl_obj.rigid_body:
+		return False
+	if bl_obj.rotation_mode == "AXIS_ANGLE":
+		return False
+	parent = bl_obj.parent
+	if parent and (bl_obj.parent_type != "OBJECT" or parent.type == "CURVE"):
+		return False
+	anim_data = bl_obj.animation_data
+	if anim_data:
+		if anim_data.drivers or anim_data.nla_tracks:
+			return False
+		if anim_data.action_influence != 1 or anim_data.action_blend_type != "REPLACE":
+			return False
+		if get_action_fcurves(anim_data) is None:
+			return False
+	return True
+
+
+# linear fcurves with constant extrapolation evaluate the same as np.interp
+def is_linear_fcurve(fcurve):
+	if fcurve.modifiers or fcurve.extrapolation != "CONSTANT":
+		return False
+	# the interpolation of the last keyframe isn't used
+	keyframes = fcurve.keyframe_points
+	return all(keyframe.interpolation == "LINEAR" for keyframe in keyframes[:-1])
+
+
+# fcurves where every keyframe and handle has the same value evaluate to
+# that value everywhere, whatever their interpolation
+def is_constant_fcurve(fcurve):
+	if fcurve.modifiers:
+		return False
+	keyframes = fcurve.keyframe_points
+	if not keyframes:
+		return True
+	coords = np.empty((3, len(keyframes) * 2), np.float32)
+	keyframes.foreach_get("co", coords[0])
+	keyframes.foreach_get("handle_left", coords[1])
+	keyframes.foreach_get("handle_right", coords[2])
+	values = coords[:, 1::2]
+	return not np.any(values != values[0, 0])
+
+
+def sample_fcurve_matrices(bl_obj, fcurves, frames):
+	num_frames = len(frames)
+	channels = {}
+	for data_path in sampled_transform_paths:
+		channels[data_path] = np.tile(np.array(getattr(bl_obj, data_path), np.float64), (num_frames, 1))
+
+	for fcurve in fcurves:
+		channel = channels.get(fcurve.data_path)
+		if channel is None or fcurve.mute:
+			continue
+		if is_constant_fcurve(fcurve):
+			channel[:, fcurve.array_index] = fcurve.evaluate(frames[0])
+			continue
+		keyframes = fcurve.keyframe_points
+		if keyframes and is_linear_fcurve(fcurve):
+			keys = np.empty(len(keyframes) * 2, np.float32)
+			keyframes.foreach_get("co", keys)
+			keys = keys.reshape((-1, 2))
+			channel[:, fcurve.array_index] = np.interp(frames, keys[:, 0], keys[:, 1])
+			continue
+		evaluate = fcurve.evaluate
+		channel[:, fcurve.array_index] = [evaluate(frame) for frame in frames]
+
+	locations = channels["location"] + channels["delta_location"]
+	scales = channels["scale"] * channels["delta_scale"]
+	rotation_mode = bl_obj.rotation_mode
+	if rotation_mode == "QUATERNION":
+		rotations = [Quaternion(rot).normalized().to_matrix() for rot in channels["rotation_quaternion"]]
+		delta_rotations = [Quaternion(rot).normalized().to_matrix() for rot in channels["delta_rotation_quaternion"]]
+	else:
+		rotations = [Euler(rot, rotation_mode).to_matrix() for rot in channels["rotation_euler"]]
+		delta_rotations = [Euler(rot, rotation_mode).to_matrix() for rot in channels["delta_rotation_euler"]]
+
+	parent_matrix = matrix_datasmith
+	if bl_obj.parent:
+		parent_matrix = matrix_datasmith @ bl_obj.matrix_parent_inverse
+	forward_matrix = matrix_datasmith_inv
+	if bl_obj.type in ["CAMERA", "LIGHT"]:
+		forward_matrix = matrix_datasmith_inv @ matrix_forward
+
+	matrices = np.empty((num_frames, 4, 4), np.float32)
+	for frame_idx, (loc, delta_rot, rot, scale) in enumerate(zip(locations, delta_rotations, rotations, scales)):
+		basis = Matrix.LocRotScale(loc, delta_rot @ rot, scale)
+		matrices[frame_idx] = parent_matrix @ basis @ forward_matrix
+	return matrices
+
+
+anim_header_format = '{\n\t"version": "0.1",\n\t"fps": %d,\n\t\t"animations": ['
+
+to_deg = 360 / math.tau
+anim_rot_fix = np.array((-to_deg, -to_deg, to_deg))
+
+
+anim_timeline_format = '{\n\t\t\t\t"actor": "%s","trans":[%s],"rot":[%s],"scl":[%s],"type":"transform"}'
+
+
+# decomposes (..., 4, 4) matrices into (..., 9) animation keys, with the
+# translation, the rotation as datasmith euler degrees, and the scale
+def matrices_to_anim_keys(matrices):
+	shape = matrices.shape[:-2]
+	locs, rots, scales = decompose_matrices(matrices.reshape((-1, 4, 4)))
+	keys = np.empty((len(locs), 9), np.float32)
+	keys[:, 0:3] = locs
+	np.multiply(rotations_to_eulers(rots), anim_rot_fix, out=keys[:, 3:6])
+	keys[:, 6:9] = scales
+	return keys.reshape(shape + (9,))
+
+
+# only uses numpy and string formatting, so it can run outside the main thread
+def format_anim_timeline(obj_name, timeline_keys, frame_ids):
+	num_frames = len(frame_ids)
+	translations = np.empty((num_frames, 4), dtype=np.float32)
+	rotations = np.empty((num_frames, 4), dtype=np.float32)
+	scales = np.empty((num_frames, 4), dtype=np.float32)
+	translations[:, 0] = rotations[:, 0] = scales[:, 0] = frame_ids
+
+	translations[:, 1:4] = timeline_keys[:, 0:3]
+	rotations[:, 1:4] = timeline_keys[:, 3:6]
+	scales[:, 1:4] = timeline_keys[:, 6:9]
+
+	np.nan_to_num(translations, copy=False, nan=0.0)
+	np.nan_to_num(rotations, copy=False, nan=0.0)
+	np.nan_to_num(scales, copy=False, nan=0.0)
+
+	return anim_timeline_format % (
+		obj_name,
+		format_anim_keys(translations),
+		format_anim_keys(rotations),
+		format_anim_keys(scales),
+	)
+
+
+# objects that can affect other objects through physics
+def affects_simulation(bl_obj):
+	if bl_obj.rigid_body or bl_obj.rigid_body_constraint:
+		return True
+	if bl_obj.field and bl_obj.field.type != "NONE":
+		return True
+	return bool(bl_obj.collision and bl_obj.collision.use)
+
+
+# hides the objects that aren't in keep_visible or their parents, returns
+# the objects that were hidden so they can be restored afterwards
+def hide_unused_objects(scene, keep_visible):
+	keep_visible = set(keep_visible)
+	for bl_obj in list(keep_visible):
+		parent = bl_obj.parent
+		while parent:
+			keep_visible.add(parent)
+			parent = parent.parent
+
+	hidden_objs = []
+	for bl_obj in scene.objects:
+		if bl_obj in keep_visible or bl_obj.hide_viewport or bl_obj.library:
+			continue
+		if affects_simulation(bl_obj):
+			continue
+		bl_obj.hide_viewport = True
+		hidden_objs.append(bl_obj)
+	return hidden_objs
+
+
+# identifies an instance across frames without building its full name
+def get_instance_key(instance):
+	return (instance.object.name, instance.parent.name, tuple(instance.persistent_id))
 
 
 def collect_anims(context, new_iterator: bool, use_instanced_meshes: bool):
 	anims = []
-	anims_strings = []
+	anim_timelines = []
 	if new_iterator:
 		log.info("collecting animations new iterator")
-		anim_objs = {}
+		# parallel lists indexed by anim_idx, frames stay None for static objects
+		anim_names = []
+		anim_frames = []
+		name_to_idx = {}
+		sampled_objs = []
+		slow_objs = []
+		slow_instances = {}
+		keep_visible = set()
+		slow_anim_idx = []
+		reference_worlds = []
+		reference_parents = []
+		slow_use_forward = []
 		d = bpy.context.evaluated_depsgraph_get()
 		for instance in d.object_instances:
 			base_name = instance.object.name
@@ -1018,96 +1398,114 @@ def collect_anims(context, new_iterator: bool, use_instanced_meshes: bool):
 					continue
 				base_name = make_instance_name(instance)
 			object_name = sanitize_name(base_name)
-			object_matrix = get_instance_local_matrix(instance)
-			anim_data = {
-				"name": object_name,
-				"animates": False,
-				"matrix": object_matrix,
-			}
-			anim_objs[object_name] = anim_data
+			if object_name in name_to_idx:
+				continue
+			anim_idx = name_to_idx[object_name] = len(anim_names)
+			anim_names.append(object_name)
+			anim_frames.append(None)
+			obj_idx = len(slow_anim_idx)
+			if instance.is_instance:
+				# names are resolved once here, the frame loop only needs the key
+				slow_instances[get_instance_key(instance)] = obj_idx
+				keep_visible.add(instance.object.original)
+				keep_visible.add(instance.parent.original)
+			else:
+				bl_obj = instance.object.original
+				if can_sample_fcurves(bl_obj):
+					sampled_objs.append((anim_idx, bl_obj))
+					continue
+				# regular objects can be read directly, without walking the object instances
+				slow_objs.append((obj_idx, bl_obj, bl_obj.parent))
+				keep_visible.add(bl_obj)
+			slow_anim_idx.append(anim_idx)
+			reference_worlds.append(np.array(instance.matrix_world, np.float32))
+			parent = get_instance_parent(instance)
+			reference_parents.append(np.array(parent.matrix_world, np.float32) if parent else identity_matrix_np)
+			slow_use_forward.append(instance.object.type in ("CAMERA", "LIGHT"))
 
 		frame_at_export_time = context.scene.frame_current
 		frame_start = context.scene.frame_start
 		frame_end = context.scene.frame_end
 
-		# TODO: found a bit late about this: we need to test and profile
-		# https://docs.blender.org/api/current/bpy_extras.anim_utils.html
-
 		num_frames = frame_end - frame_start + 1
+		frame_range = range(frame_start, frame_end + 1)
 
-		for frame_idx in range(frame_start, frame_end + 1):
-			log.info("collecting frame %d" % frame_idx)
-			context.scene.frame_set(frame_idx)
-			d = bpy.context.evaluated_depsgraph_get()
-			for instance in d.object_instances:
-				base_name = instance.object.name
-				if instance.is_instance:
-					if use_instanced_meshes:
-						# instanced meshes can't be animated
+		# fast path: sample the fcurves of objects that don't depend on the depsgraph
+		for anim_idx, bl_obj in sampled_objs:
+			bl_anim_data = bl_obj.animation_data
+			if not bl_anim_data or not bl_anim_data.action:
+				continue
+			# actions that only hold a pose don't need to be sampled
+			fcurves = get_action_fcurves(bl_anim_data)
+			if all(is_constant_fcurve(fcurve) for fcurve in fcurves if fcurve.data_path in sampled_transform_paths and not fcurve.mute):
+				continue
+			# compare against a sampled reference so both sides get the same float error
+			reference_keys = matrices_to_anim_keys(sample_fcurve_matrices(bl_obj, fcurves, (frame_at_export_time,)))
+			frame_keys = matrices_to_anim_keys(sample_fcurve_matrices(bl_obj, fcurves, frame_range))
+			if np.any(np.abs(frame_keys - reference_keys) > anim_tolerance):
+				anim_frames[anim_idx] = frame_keys
+
+		# slow path: objects with constraints, drivers or instancers need a full
+		# depsgraph evaluation per frame
+		reference_worlds = np.array(reference_worlds, np.float32).reshape((-1, 4, 4))
+		reference_parents = np.array(reference_parents, np.float32).reshape((-1, 4, 4))
+		slow_use_forward = np.array(slow_use_forward, bool)
+		reference_keys = matrices_to_anim_keys(to_datasmith_local(reference_worlds, reference_parents, slow_use_forward))
+
+		# each frame is decomposed right after it's collected, so we only keep
+		# 9 floats per object and frame instead of the world and parent matrices
+		slow_keys = np.empty((len(slow_anim_idx), num_frames, 9), np.float32)
+		frame_worlds = np.empty_like(reference_worlds)
+		frame_parents = np.empty_like(reference_parents)
+
+		# objects the slow path doesn't read don't need to be evaluated every frame,
+		# dependencies of the visible objects are still evaluated by the depsgraph
+		hidden_objs = hide_unused_objects(context.scene, keep_visible) if slow_anim_idx else []
+		try:
+			# frame_set updates the same depsgraph, so we keep using `d`
+			for frame_idx in frame_range if slow_anim_idx else ():
+				log.info("collecting frame %d" % frame_idx)
+				context.scene.frame_set(frame_idx)
+				# start from the reference matrices, in case an instance is missing in this frame
+				frame_worlds[:] = reference_worlds
+				frame_parents[:] = reference_parents
+				for obj_idx, bl_obj, parent in slow_objs:
+					frame_worlds[obj_idx] = bl_obj.evaluated_get(d).matrix_world
+					if parent:
+						frame_parents[obj_idx] = parent.evaluated_get(d).matrix_world
+
+				for instance in d.object_instances if slow_instances else ():
+					if not instance.is_instance:
 						continue
-					base_name = make_instance_name(instance)
-				object_name = sanitize_name(base_name)
-				anim_data = anim_objs[object_name]
-				animates = anim_data["animates"]
-
-				instance_matrix = get_instance_local_matrix(instance)
-
-				if not animates:
-					# TODO: maybe don't use != here, instead use some kind of threshold to avoid
-					# a false positive from float jitter
-					if anim_data["matrix"] != instance_matrix:
-						animates = anim_data["animates"] = True
-						anim_data["frames"] = []
+					obj_idx = slow_instances.get(get_instance_key(instance))
+					if obj_idx is None:
+						continue
+					frame_worlds[obj_idx] = instance.matrix_world
+					parent = get_instance_parent(instance)
+					if parent:
+						frame_parents[obj_idx] = parent.matrix_world
+
+				# held frames are common, a bulk compare is cheaper than the decompose
+				if np.array_equal(frame_worlds, reference_worlds) and np.array_equal(frame_parents, reference_parents):
+					slow_keys[:, frame_idx - frame_start] = reference_keys
+					continue
+				frame_matrices = to_datasmith_local(frame_worlds, frame_parents, slow_use_forward)
+				slow_keys[:, frame_idx - frame_start] = matrices_to_anim_keys(frame_matrices)
+		finally:
+			for bl_obj in hidden_objs:
+				bl_obj.hide_viewport = False
 
-				if animates:
-					frames = anim_data["frames"]
-					frames.append(instance_matrix.copy())
+		# using a tolerance avoids false positives from float jitter
+		changed = np.abs(slow_keys - reference_keys[:, None]) > anim_tolerance
+		for obj_idx in np.flatnonzero(changed.any(axis=(1, 2))):
+			anim_frames[slow_anim_idx[obj_idx]] = slow_keys[obj_idx]
 
 		# write phase:
-		to_deg = 360 / math.tau
-		rot_fix = np.array((-to_deg, -to_deg, to_deg))
-		for obj_name, obj_data in anim_objs.items():
-			if not obj_data["animates"]:
+		for obj_name, frames in zip(anim_names, anim_frames):
+			if frames is None:
 				continue
 			log.info(f"writing animation for obj:{obj_name}")
-
-			timeline_repr = [
-				'''{
-				"actor": "''',
-				obj_name,
-				'",',
-			]
-
-			translations = np.empty((num_frames, 4), dtype=np.float32)
-			rotations = np.empty((num_frames, 4), dtype=np.float32)
-			scales = np.empty((num_frames, 4), dtype=np.float32)
-			translations[:, 0] = np.arange(frame_start, frame_end + 1)
-			rotations[:, 0] = np.arange(frame_start, frame_end + 1)
-			scales[:, 0] = np.arange(frame_start, frame_end + 1)
-
-			timeline = obj_data["frames"]
-			for frame_idx, frame_mat in enumerate(timeline):
-				loc, rot, scale = frame_mat.decompose()
-				# tx_slice = (frame_idx, slice(1, 4))
-				translations[frame_idx, 1:4] = loc
-				rotations[frame_idx, 1:4] = rot_fix * rot.to_euler("XYZ")
-				scales[frame_idx, 1:4] = scale
-
-			translations[np.isnan(translations)] = 0
-			trans_expression = ",".join('{"id":%d,"x":%f,"y":%f,"z":%f}' % tuple(v) for v in translations)
-			timeline_repr.extend(('"trans":[', trans_expression, "],"))
-
-			rotations[np.isnan(rotations)] = 0
-			rot_expression = ",".join('{"id":%d,"x":%f,"y":%f,"z":%f}' % tuple(v) for v in rotations)
-			timeline_repr.extend(('"rot":[', rot_expression, "],"))
-
-			scales[np.isnan(scales)] = 0
-			scale_expression = ",".join('{"id":%d,"x":%f,"y":%f,"z":%f}' % tuple(v) for v in scales)
-			timeline_repr.extend(('"scl":[', scale_expression, "],"))
-
-			timeline_repr.append('"type":"transform"}')
-			result = "".join(timeline_repr)
-			anims_strings.append(result)
+			anim_timelines.append((obj_name, frames))
 
 	else:  # if not new_iterator
 		frame_at_export_time = context.scene.frame_current
@@ -1121,82 +1519,42 @@ def collect_anims(context, new_iterator: bool, use_instanced_meshes: bool):
 
 		num_frames = frame_end - frame_start + 1
 		num_objects = len(anim_objs)
-		object_timelines = [[Matrix() for frame in range(num_frames)] for obj in range(num_objects)]
-		object_animates = [False for num in range(num_objects)]
+		object_timelines = np.empty((num_objects, num_frames, 4, 4), np.float32)
 		# collect phase?
 
 		for arr_idx, frame_idx in enumerate(range(frame_start, frame_end + 1)):
 			context.scene.frame_set(frame_idx)
 
 			for obj_idx, obj in enumerate(anim_objs):
-				obj_mat = collect_object_transform(obj[0])
-				object_timelines[obj_idx][arr_idx] = obj_mat
-
-				if arr_idx == 0:
-					continue
+				# the returned matrix is frozen, numpy can only read a copy
+				object_timelines[obj_idx, arr_idx] = collect_object_transform(obj[0]).copy()
 
-				if not object_animates[obj_idx]:
-					changed = obj_mat != object_timelines[obj_idx][arr_idx - 1]
-					if changed:
-						object_animates[obj_idx] = True
+		object_timelines = matrices_to_anim_keys(object_timelines)
+		changed = np.abs(object_timelines - object_timelines[:, :1]) > anim_tolerance
+		object_animates = changed.any(axis=(1, 2))
 
-		anims_strings = []
 		# write phase:
-		to_deg = 360 / math.tau
-		rot_fix = np.array((-to_deg, -to_deg, to_deg))
 		for idx, timeline in enumerate(object_timelines):
 			if not object_animates[idx]:
 				continue
 			log.error(f"writing obj:{idx}")
-
-			timeline_repr = [
-				'''{
-				"actor": "''',
-				anim_objs[idx][1],
-				'",',
-			]
-
-			translations = np.empty((num_frames, 4), dtype=np.float32)
-			rotations = np.empty((num_frames, 4), dtype=np.float32)
-			scales = np.empty((num_frames, 4), dtype=np.float32)
-			translations[:, 0] = np.arange(frame_start, frame_end + 1)
-			rotations[:, 0] = np.arange(frame_start, frame_end + 1)
-			scales[:, 0] = np.arange(frame_start, frame_end + 1)
-
-			for frame_idx, frame_mat in enumerate(timeline):
-				loc, rot, scale = frame_mat.decompose()
-				# tx_slice = (frame_idx, slice(1, 4))
-				translations[frame_idx, 1:4] = loc
-				rotations[frame_idx, 1:4] = rot_fix * rot.to_euler("XYZ")
-				scales[frame_idx, 1:4] = scale
-
-			trans_expression = ",".join('{"id":%d,"x":%f,"y":%f,"z":%f}' % tuple(v) for v in translations)
-			timeline_repr.extend(('"trans":[', trans_expression, "],"))
-
-			rot_expression = ",".join('{"id":%d,"x":%f,"y":%f,"z":%f}' % tuple(v) for v in rotations)
-			timeline_repr.extend(('"rot":[', rot_expression, "],"))
-
-			scale_expression = ",".join('{"id":%d,"x":%f,"y":%f,"z":%f}' % tuple(v) for v in scales)
-			timeline_repr.extend(('"scl":[', scale_expression, "],"))
-
-			timeline_repr.append('"type":"transform"}')
-			result = "".join(timeline_repr)
-			anims_strings.append(result)
-
-	if anims_strings:
-		output = [
-			"""\
-{
-	"version": "0.1",
-	"fps": """,
-			str(context.scene.render.fps),
-			""",\n\t\t"animations": [""",
-			",".join(anims_strings),
-			"\n\t]\n}",
-		]
-
-		output_text = "".join(output)
-		anims.append(output_text)
+			anim_timelines.append((anim_objs[idx][1], timeline))
+
+	if anim_timelines:
+		output = io.StringIO()
+		write = output.write
+		write(anim_header_format % context.scene.render.fps)
+		obj_names, timelines = zip(*anim_timelines)
+		# the id column is the same for every key array of every object
+		frame_ids = np.arange(frame_start, frame_end + 1, dtype=np.float32)
+		with ThreadPoolExecutor() as executor:
+			formatted = executor.map(format_anim_timeline, obj_names, timelines, repeat(frame_ids))
+			for idx, timeline_text in enumerate(formatted):
+				if idx:
+					write(",")
+				write(timeline_text)
+		write("\n\t]\n}")
+		anims.append(output.getvalue())
 
 		# cleanup
 	context.scene.frame_set(frame_at_export_time)
@@ -1207,6 +1565,18 @@ def collect_anims(context, new_iterator: bool, use_instanced_meshes: bool):
 datasmith_context = None
 
 
+# the export summary reports the size in characters, like the length of the
+# rendered string it used to be, so this counts them while writing the file
+# (f.tell() would count bytes)
+class CharCountingWriter:
+	def __init__(self, fp):
+		self.fp_write = fp.write
+		self.size = 0
+
+	def write(self, text):
+		self.size += self.fp_write(text)
+
+
 def collect_and_save(context, args, save_path):
 	start_time = time.monotonic()
 	summary = {}
@@ -1223,6 +1593,8 @@ def collect_and_save(context, args, save_path):
 		"metadata": [],
 		"compatibility_mode": args["compatibility_mode"],
 		"libraries": {},
+		"library_prefixes": set(),
+		"pending_transforms": [],
 	}
 
 	log.info("collecting objects")
@@ -1238,27 +1610,25 @@ def collect_and_save(context, args, save_path):
 	log.info("USE NEW OBJECT ITERATOR")
 	obj_output = collect_depsgraph(objects, use_instanced_meshes, selected_only)
 
-	anims = []
-	if export_animations:
-		anims = collect_anims(context, not use_old_iterator, use_instanced_meshes)
-
 	all_textures = {}
 	environment = collect_environment(context.scene.world, all_textures)
 
 	log.info("Collecting materials")
 	materials = datasmith_context["materials"]
-	unique_materials = []
+	# materials here are tuple (material, owner), we keep the first owner of each material
+	unique_materials = {}
 	for material in materials:
-		found = False
-		for mat in unique_materials:
-			if material[0] is mat[0]:  # materials here are tuple (material, owner)
-				found = True
-				break
-		if not found:
-			unique_materials.append(material)
+		unique_materials.setdefault(id(material[0]), material)
+	unique_materials = list(unique_materials.values())
 
 	material_nodes = collect_all_materials(unique_materials, all_textures, config_always_twosided)
 
+	# animations go last, hiding objects during the frame loop rebuilds the
+	# depsgraph, which invalidates the evaluated objects referenced above
+	anims = []
+	if export_animations:
+		anims = collect_anims(context, not use_old_iterator, use_instanced_meshes)
+
 	log.info("finished collecting, now saving")
 
 	basedir, file_name = path.split(save_path)
@@ -1286,7 +1656,10 @@ def collect_and_save(context, args, save_path):
 
 	log.info("writing meshes")
 	meshes = datasmith_context["meshes"].values()
-	mesh_nodes = [mesh_save(mesh, basedir, folder_name) for mesh in meshes]
+	# mesh data is already in numpy arrays, so saving doesn't touch blender
+	# data and can run in threads, hashing and file writes release the GIL
+	with ThreadPoolExecutor() as executor:
+		mesh_nodes = list(executor.map(mesh_save, meshes, repeat(basedir), repeat(folder_name)))
 
 	log.info("writing textures")
 
@@ -1327,18 +1700,18 @@ def collect_and_save(context, args, save_path):
 	log.info("generating datasmith data took:%f" % total_time)
 	# n.push(Node("Export", {"Duration": total_time}))
 
-	log.info("generating xml")
-	result = n.string_rep(first=True)
-
 	filename = path.join(basedir, file_name + ".udatasmith")
-	log.info("writing to file: %s" % filename)
+	log.info("writing xml to file: %s" % filename)
 
 	with open(filename, "w") as f:
-		f.write(result)
+		counting_writer = CharCountingWriter(f)
+		n.write_to(counting_writer, first=True)
+		output_size = counting_writer.size
+	scratch_buffers.clear()
 	log.info("export finished")
 
 	summary["Time"] = total_time
-	summary["Size"] = len(result)
+	summary["Size"] = output_size
 
 	return summary
 
@@ -1390,6 +1763,7 @@ def save(context, kwargs):
 		raise
 
 	finally:
+		sanitize_name.cache_clear()
 		if use_logging:
 			log.info("Finished logging to path:" + log_path)
 			handler.close()
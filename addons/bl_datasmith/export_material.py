@@ -4,6 +4,7 @@
 
 import math
 import logging
+import sys
 
 import numpy as np
 
@@ -24,15 +25,15 @@ BLENDER_CURVES_NAME = "blender_curves"
 
 def collect_all_materials(unique_materials, textures_dict, config_always_twosided):
 	global material_curves
-	global material_curves_count
 	global tex_dict
-	material_curves = np.zeros((DATASMITH_TEXTURE_SIZE, DATASMITH_TEXTURE_SIZE, 4))
-	material_curves_count = 0
+	global uv_channels_cache
+	uv_channels_cache = {}
+	material_curves = []
 	tex_dict = textures_dict
 
 	material_nodes = [collect_pbr_material(mat, config_always_twosided) for mat in unique_materials]
 
-	if material_curves_count != 0:
+	if material_curves:
 		curves_image = None
 		if BLENDER_CURVES_NAME in bpy.data.images:
 			curves_image = bpy.data.images[BLENDER_CURVES_NAME]
@@ -41,7 +42,10 @@ def collect_all_materials(unique_materials, textures_dict, config_always_twoside
 			curves_image.colorspace_settings.is_data = True
 			curves_image.file_format = "OPEN_EXR"
 
-		curves_image.pixels[:] = material_curves.reshape((-1,))
+		# curves are written from the top row down, the rest is left black
+		curves_pixels = np.zeros((DATASMITH_TEXTURE_SIZE, DATASMITH_TEXTURE_SIZE, 4), np.float32)
+		curves_pixels[DATASMITH_TEXTURE_SIZE - len(material_curves) :] = material_curves[::-1]
+		curves_image.pixels.foreach_set(curves_pixels.reshape((-1,)))
 
 		# add image to textures_dict
 		get_texture_name(textures_dict, curves_image)
@@ -68,8 +72,20 @@ def collect_pbr_material(mat_with_owner, config_always_twosided):
 	global reported_errors
 	global reported_warns
 	global material_owner
+	global cached_constants
+	global cached_mappings
+	global cached_signatures
+	global cached_function_calls
+	global cached_groups
+	global scalar_constants
 	reported_errors = set()
 	reported_warns = set()
+	cached_constants = {}
+	cached_mappings = {}
+	cached_signatures = {}
+	cached_function_calls = {}
+	cached_groups = {}
+	scalar_constants = {}
 
 	material_owner = mat_with_owner[1]
 
@@ -84,34 +100,30 @@ def collect_pbr_material(mat_with_owner, config_always_twosided):
 	return pbr_nodetree_material(material, config_always_twosided)
 
 
+# divide range 0-1 in 1023 parts
+CURVE_SAMPLE_POSITIONS = [idx / DATASMITH_TEXTURE_SIZE for idx in range(DATASMITH_TEXTURE_SIZE)]
+
+
 def add_material_curve(curve):
-	global material_curves
-	global material_curves_count
-	mat_curve_idx = material_curves_count
-	material_curves_count += 1
+	mat_curve_idx = len(material_curves)
 	log.info("writing curve:%s" % mat_curve_idx)
 
-	# write texture from top
-	row_idx = DATASMITH_TEXTURE_SIZE - mat_curve_idx - 1
-	values = material_curves[row_idx]
-	factor = DATASMITH_TEXTURE_SIZE  # divide range 0-1 in 1023 parts
+	# only the rows in use are allocated, the texture is assembled at the end
+	values = np.zeros((DATASMITH_TEXTURE_SIZE, 4), np.float32)
+	material_curves.append(values)
 
 	# check for curve type, do sampling
+	# samples are collected in lists and written to the row in one go,
+	# assigning each sample to the array is much slower
 	curve_type = type(curve)
 	if curve_type is bpy.types.ColorRamp:
-		for idx in range(DATASMITH_TEXTURE_SIZE):
-			values[idx] = curve.evaluate(idx / factor)
+		evaluate = curve.evaluate
+		values[:] = [evaluate(position) for position in CURVE_SAMPLE_POSITIONS]
 
 	elif curve_type is bpy.types.CurveMapping:
-		curves = curve.curves
-
-		position = 0
-		for idx in range(DATASMITH_TEXTURE_SIZE):
-			position = idx / factor
-			values[idx, 0] = curve.evaluate(curves[0], position)
-			values[idx, 1] = curve.evaluate(curves[1], position)
-			values[idx, 2] = curve.evaluate(curves[2], position)
-			values[idx, 3] = curve.evaluate(curves[3], position)
+		evaluate = curve.evaluate
+		for channel_idx, channel_curve in enumerate(curve.curves[:4]):
+			values[:, channel_idx] = [evaluate(channel_curve, position) for position in CURVE_SAMPLE_POSITIONS]
 
 	return mat_curve_idx
 
@@ -322,30 +334,83 @@ def pbr_nodetree_material(material, config_always_twosided):
 	return n
 
 
+# constant expressions are shared inside a material, keyed by their
+# formatted value. we only have one exp_list per material, so this gets
+# reset in collect_pbr_material
+cached_constants = {}
+
+# bound formatters for the constants, these are called for every constant
+# expression so we skip the % operator dispatch
+SCALAR_FORMAT = "%f".__mod__
+VECTOR_FORMAT = "(R=%.6f,G=%.6f,B=%.6f,A=1.0)".__mod__
+COLOR_FORMAT = "(R=%.6f,G=%.6f,B=%.6f,A=%.6f)".__mod__
+
+
 def exp_scalar(value, exp_list):
-	n = Node(
-		"Scalar",
-		{
-			# "Name": "",
-			"constant": "%f" % value
-		},
-	)
-	return exp_list.push(n)
+	constant = SCALAR_FORMAT(value)
+	key = ("Scalar", constant)
+	exp_idx = cached_constants.get(key)
+	if exp_idx is None:
+		n = Node(
+			"Scalar",
+			{
+				# "Name": "",
+				"constant": constant
+			},
+		)
+		exp_idx = exp_list.push(n)
+		cached_constants[key] = exp_idx
+		scalar_constants[exp_idx] = float(constant)
+	return exp_idx
 
 
+# value of the scalar constant expressions, by expression index, so some
+# operations can be folded at export time. also reset per material
+scalar_constants = {}
+
+
+# returns the value written for a scalar constant expression, or None if
+# the expression isn't one
+def get_scalar_constant(expression):
+	exp_key = get_exp_key(expression)
+	if type(exp_key) is tuple and exp_key[1] == 0:
+		return scalar_constants.get(exp_key[0])
+	return None
+
+
+# value can be any 3 float sequence, callers that already have a tuple
+# (like the texture mapping values) skip the conversion
 def exp_vector(value, exp_list):
-	n = Node(
-		"Color",
-		{
-			# "Name": name,
-			"constant": "(R=%.6f,G=%.6f,B=%.6f,A=1.0)" % tuple(value)
-		},
-	)
-	return exp_list.push(n)
+	if type(value) is not tuple:
+		value = tuple(value)
+	constant = VECTOR_FORMAT(value)
+	key = ("Vector", constant)
+	exp_idx = cached_constants.get(key)
+	if exp_idx is None:
+		n = Node(
+			"Color",
+			{
+				# "Name": name,
+				"constant": constant
+			},
+		)
+		exp_idx = exp_list.push(n)
+		cached_constants[key] = exp_idx
+	return exp_idx
 
 
 def exp_color(value, exp_list, name=None):
-	color = Node("Color", {"constant": "(R=%.6f,G=%.6f,B=%.6f,A=%.6f)" % tuple(value)})
+	if type(value) is not tuple:
+		value = tuple(value)
+	constant = COLOR_FORMAT(value)
+	# named colors are left alone, as they're meant to be a distinct expression
+	key = ("Color", constant)
+	if not name:
+		exp_idx = cached_constants.get(key)
+		if exp_idx is not None:
+			return exp_idx
+
+	color = Node("Color", {"constant": constant})
 	if name:
 		color["Name"] = name
 	color_exp = exp_list.push(color)
@@ -356,7 +421,10 @@ def exp_color(value, exp_list, name=None):
 	push_exp_input(append, "0", color_exp)
 	push_exp_input(append, "1", alpha_exp)
 
-	return exp_list.push(append)
+	exp_idx = exp_list.push(append)
+	if not name:
+		cached_constants[key] = exp_idx
+	return exp_idx
 
 
 def exp_output(output_id, expression):
@@ -398,6 +466,16 @@ def get_context():
 		return context_stack[-1]
 
 
+# handlers name their inputs with small ints or their str, so the input
+# name part is formatted once per index here instead of on every input
+EXP_INPUT_FORMATS = {}
+for input_idx in range(32):
+	input_format = '\n\t\t\t\t<Input Name="%s" expression="%%s" OutputIndex="%%s"/>' % input_idx
+	EXP_INPUT_FORMATS[input_idx] = input_format
+	EXP_INPUT_FORMATS[str(input_idx)] = input_format
+del input_idx, input_format
+
+
 def exp_input(input_idx, expression, output_idx=0):
 	expression_idx = -1
 	if type(expression) is dict:
@@ -418,7 +496,10 @@ def exp_input(input_idx, expression, output_idx=0):
 	# if expression_idx == -1:
 	# report_error("trying to use expression=None for input for another expression")
 
-	return '\n\t\t\t\t<Input Name="%s" expression="%s" OutputIndex="%s"/>' % (input_idx, expression_idx, output_idx)
+	input_format = EXP_INPUT_FORMATS.get(input_idx)
+	if input_format is None:
+		return '\n\t\t\t\t<Input Name="%s" expression="%s" OutputIndex="%s"/>' % (input_idx, expression_idx, output_idx)
+	return input_format % (expression_idx, output_idx)
 
 
 # convenience function to skip adding an input if the input is None
@@ -427,6 +508,50 @@ def push_exp_input(node, input_idx, expression, output_idx=0):
 		node.push(exp_input(input_idx, expression, output_idx))
 
 
+# formats a list of expressions as inputs numbered from 0, skipping the ones
+# that are None but keeping their index like push_exp_input would
+def get_exp_inputs(expressions):
+	return [exp_input(idx, expression) for idx, expression in enumerate(expressions) if expression is not None]
+
+
+def push_exp_inputs(node, expressions):
+	node.children.extend(get_exp_inputs(expressions))
+
+
+# function calls only depend on the function and their inputs, so identical
+# calls in the same material share a single expression
+cached_function_calls = {}
+
+
+def exp_cached_function_call(function_path, inputs, exp_list):
+	key = (function_path, *inputs)
+	exp_idx = cached_function_calls.get(key)
+	if exp_idx is None:
+		n = Node("FunctionCall", {"Function": function_path})
+		n.children = inputs
+		exp_idx = exp_list.push(n)
+		cached_function_calls[key] = exp_idx
+	return exp_idx
+
+
+# clamps are added for most mix factors, so they are shared the same way,
+# and clamping a constant just writes the clamped constant
+def exp_saturate(expression, exp_list):
+	value = get_scalar_constant(expression)
+	if value is not None:
+		return exp_scalar(min(max(value, 0.0), 1.0), exp_list)
+
+	inputs = get_exp_inputs((expression,))
+	key = ("Saturate", *inputs)
+	exp_idx = cached_function_calls.get(key)
+	if exp_idx is None:
+		n = Node("Saturate")
+		n.children = inputs
+		exp_idx = exp_list.push(n)
+		cached_function_calls[key] = exp_idx
+	return exp_idx
+
+
 expression_log_prefix = ""
 
 
@@ -437,29 +562,34 @@ def get_expression(field, exp_list, force_default=False, skip_default_warn=False
 	# TODO: check which cases we should be careful
 	global expression_log_prefix
 	node = field.node
-	log.debug(
-		"%s%s:%s/%s:%s"
-		% (
-			expression_log_prefix,
-			node.type,
-			node.name,
-			field.type,
-			field.name,
+	field_type = field.type
+	if log.isEnabledFor(logging.DEBUG):
+		log.debug(
+			"%s%s:%s/%s:%s"
+			% (
+				expression_log_prefix,
+				node.type,
+				node.name,
+				field_type,
+				field.name,
+			)
 		)
-	)
 
-	if not field.links or not field.links[0].from_socket.enabled:
-		if field.type == "VALUE":
+	# socket.links is computed in python by scanning every link in the node
+	# tree, so we read it only once
+	links = field.links
+	if not links or not links[0].from_socket.enabled:
+		if field_type == "VALUE":
 			exp = exp_scalar(field.default_value, exp_list)
 			return {"expression": exp, "OutputIndex": 0}
-		elif field.type == "RGBA":
+		elif field_type == "RGBA":
 			color_value = field.default_value
 
 			if get_context() == MAT_CTX_NORMAL:
 				color_value = (color_value[0] * 2.0 - 1.0, color_value[1] * 2.0 - 1.0, color_value[2] * 2.0 - 1.0, color_value[3])
 			exp = exp_color(color_value, exp_list)
 			return {"expression": exp, "OutputIndex": 0}
-		elif field.type == "VECTOR":
+		elif field_type == "VECTOR":
 			use_vector_default = force_default or type(field.default_value) in {Vector, Euler}
 			# here, we're specifically discarding when the field type is
 			# bpy.types.bpy_prop_array. we do that because when that happens,
@@ -470,7 +600,7 @@ def get_expression(field, exp_list, force_default=False, skip_default_warn=False
 			if use_vector_default:
 				exp = exp_vector(field.default_value, exp_list)
 				return {"expression": exp, "OutputIndex": 0}
-		elif field.type == "SHADER":
+		elif field_type == "SHADER":
 			# same as holdout shader
 			bsdf = {
 				"BaseColor": {"expression": exp_scalar(0.0, exp_list)},
@@ -485,23 +615,23 @@ def get_expression(field, exp_list, force_default=False, skip_default_warn=False
 	prev_prefix = expression_log_prefix
 	expression_log_prefix += "|   "
 
-	socket = field.links[0].from_socket
+	socket = links[0].from_socket
 	return_exp = get_expression_inner(socket, exp_list, field)
 	expression_log_prefix = prev_prefix
 
 	reverse_expressions[socket] = return_exp
 
 	if return_exp:
-		other_output = field.links[0].from_socket
+		other_output_type = socket.type
 		# if a color output is connected to a scalar input, average by using dot product
-		if field.type == "VALUE":
-			if other_output.type == "RGBA":
+		if field_type == "VALUE":
+			if other_output_type == "RGBA":
 				n = Node("FunctionCall", {"Function": MAT_FUNC_RGB_TO_BW})
 				push_exp_input(n, "0", return_exp)
 				dot_exp = exp_list.push(n)
 				return_exp = {"expression": dot_exp}
 
-			elif other_output.type == "VECTOR":
+			elif other_output_type == "VECTOR":
 				n = Node("DotProduct")
 				exp_0 = return_exp
 				n.push(exp_input("0", exp_0))
@@ -509,8 +639,8 @@ def get_expression(field, exp_list, force_default=False, skip_default_warn=False
 				n.push(exp_input("1", {"expression": exp_1}))
 				dot_exp = exp_list.push(n)
 				return_exp = {"expression": dot_exp}
-		elif field.type == "VECTOR":
-			if other_output.type == "RGBA":
+		elif field_type == "VECTOR":
+			if other_output_type == "RGBA":
 				n = Node("ComponentMask")
 				push_exp_input(n, "0", return_exp)
 				n.push('<Prop name="R" val="True" type="Bool" />')
@@ -518,14 +648,14 @@ def get_expression(field, exp_list, force_default=False, skip_default_warn=False
 				n.push('<Prop name="B" val="True" type="Bool" />')
 				return_exp = {"expression": exp_list.push(n)}
 
-		elif field.type == "RGBA":
-			if other_output.type == "VECTOR":
+		elif field_type == "RGBA":
+			if other_output_type == "VECTOR":
 				alpha = exp_scalar(1, exp_list)  # Don't know if its better to use 0 or 1 here
 				n = Node("AppendVector")
 				push_exp_input(n, "0", return_exp)
 				push_exp_input(n, "1", alpha)
 				return_exp = {"expression": exp_list.push(n)}
-			elif other_output.type == "VALUE":
+			elif other_output_type == "VALUE":
 				# This makes the output safer, because next node may expect this is a vector
 				n = Node("FunctionCall", {"Function": MAT_FUNC_COMBINE_RGB})
 				push_exp_input(n, "0", return_exp)
@@ -533,9 +663,8 @@ def get_expression(field, exp_list, force_default=False, skip_default_warn=False
 				push_exp_input(n, "2", return_exp)
 				return_exp = {"expression": exp_list.push(n)}
 
-		elif field.type == "SHADER":
-			other_output = field.links[0].from_socket
-			if other_output.type != "SHADER":
+		elif field_type == "SHADER":
+			if other_output_type != "SHADER":
 				# maybe a color or a value was connected to a shader socket
 				# so we convert whatever value came to a basic emissive shader
 				value_exp = return_exp
@@ -549,6 +678,19 @@ def get_expression(field, exp_list, force_default=False, skip_default_warn=False
 	return return_exp
 
 
+# node.inputs[name] does a lookup in the collection every time, this
+# builds a dict once for handlers that read many inputs. names are matched
+# first like bpy does, identifiers are there as fallback for renamed sockets
+def get_named_inputs(node):
+	named_inputs = {}
+	inputs = node.inputs
+	for input in inputs:
+		named_inputs.setdefault(input.name, input)
+	for input in inputs:
+		named_inputs.setdefault(input.identifier, input)
+	return named_inputs
+
+
 def exp_from_cache(cached_node, socket_name):
 	socket_names = cached_node[1]
 	# Blender 5.0 changed "Fac" sockets label to "Factor"
@@ -589,18 +731,19 @@ def get_expression_inner(socket, exp_list, target_socket):
 	# Shader nodes return a dictionary
 	bsdf = None
 	if node.type == "BSDF_PRINCIPLED":
+		inputs = get_named_inputs(node)
 		bsdf = {
-			"BaseColor": get_expression(node.inputs["Base Color"], exp_list),
-			"Metallic": get_expression(node.inputs["Metallic"], exp_list),
-			"Roughness": get_expression(node.inputs["Roughness"], exp_list),
+			"BaseColor": get_expression(inputs["Base Color"], exp_list),
+			"Metallic": get_expression(inputs["Metallic"], exp_list),
+			"Roughness": get_expression(inputs["Roughness"], exp_list),
 		}
-		specular = node.inputs.get("Specular IOR Level")
+		specular = inputs.get("Specular IOR Level")
 		if not specular:
-			specular = node.inputs["Specular"]
+			specular = inputs["Specular"]
 		bsdf["Specular"] = get_expression(specular, exp_list)
 
 		# only add opacity if alpha != 1
-		opacity_field = node.inputs["Alpha"]
+		opacity_field = inputs["Alpha"]
 		add_opacity = False
 		if len(opacity_field.links) != 0:
 			add_opacity = True
@@ -609,10 +752,10 @@ def get_expression_inner(socket, exp_list, target_socket):
 		if add_opacity:
 			bsdf["Opacity"] = get_expression(opacity_field, exp_list)
 
-		emission_field = node.inputs.get("Emission Color")
+		emission_field = inputs.get("Emission Color")
 		if not emission_field:
-			emission_field = node.inputs["Emission"]
-		emission_strength_field = node.inputs["Emission Strength"]
+			emission_field = inputs["Emission"]
+		emission_strength_field = inputs["Emission Strength"]
 		multiply_emission = False
 		if len(emission_strength_field.links) != 0:
 			multiply_emission = True
@@ -628,18 +771,18 @@ def get_expression_inner(socket, exp_list, target_socket):
 
 		use_clear_coat = False
 
-		clear_coat_field = node.inputs.get("Coat Weight")
+		clear_coat_field = inputs.get("Coat Weight")
 		if not clear_coat_field:
-			clear_coat_field = node.inputs["Clearcoat"]
+			clear_coat_field = inputs["Clearcoat"]
 		if len(clear_coat_field.links) != 0:
 			use_clear_coat = True
 		elif clear_coat_field.default_value != 0:
 			use_clear_coat = True
 		if use_clear_coat:
 			clear_coat_exp = get_expression(clear_coat_field, exp_list)
-			clear_coat_roughness_field = node.inputs.get("Coat Roughness")
+			clear_coat_roughness_field = inputs.get("Coat Roughness")
 			if not clear_coat_roughness_field:
-				clear_coat_roughness_field = node.inputs["Clearcoat Roughness"]
+				clear_coat_roughness_field = inputs["Clearcoat Roughness"]
 			clear_coat_roughness_exp = get_expression(clear_coat_roughness_field, exp_list)
 			bsdf["ClearCoat"] = clear_coat_exp
 			bsdf["ClearCoatRoughness"] = clear_coat_roughness_exp
@@ -841,16 +984,117 @@ def get_expression_inner(socket, exp_list, target_socket):
 	# from here the return type should be {expression:node_idx, OutputIndex: socket_idx}
 	node_handler = node_handlers.get(node.type)
 	if node_handler:
-		return node_handler(socket, exp_list)
+		signature = None
+		if node.type in SIGNATURE_CACHED_NODES:
+			signature = get_node_signature(node)
+			if signature:
+				cached_node = cached_signatures.get(signature)
+				if cached_node:
+					cached_nodes[node] = cached_node
+					return exp_from_cache(cached_node, socket.name)
+
+		result = node_handler(socket, exp_list)
+		if signature:
+			cached_signatures[signature] = cached_nodes[node]
+		return result
 
 	report_error("Node %s:%s not handled" % (node.type, socket.name))
 	exp = exp_scalar(0, exp_list)
 	return {"expression": exp}
 
 
+# nodes with all inputs unlinked only depend on their settings, so when a
+# material has copies of the same node we can reuse the first one. this is
+# done for the procedural textures, as their handlers fill cached_nodes
+SIGNATURE_CACHED_NODES = {
+	"TEX_BRICK",
+	"TEX_CHECKER",
+	"TEX_GRADIENT",
+	"TEX_MAGIC",
+	"TEX_NOISE",
+	"TEX_VORONOI",
+	"TEX_WAVE",
+	"TEX_WHITE_NOISE",
+}
+SIGNATURE_SIMPLE_PROPS = {"BOOLEAN", "INT", "FLOAT", "ENUM", "STRING"}
+SIGNATURE_STRUCTS = {"TexMapping"}
+cached_signatures = {}
+
+
+def get_struct_signature(struct, skip_props=()):
+	values = []
+	for prop in struct.bl_rna.properties:
+		prop_id = prop.identifier
+		if prop_id in skip_props or prop_id == "rna_type":
+			continue
+		prop_type = prop.type
+		if prop_type in SIGNATURE_SIMPLE_PROPS:
+			value = getattr(struct, prop_id)
+			if prop_type == "ENUM" and prop.is_enum_flag:
+				value = tuple(sorted(value))
+			elif getattr(prop, "is_array", False):
+				value = tuple(value)
+			values.append(value)
+		elif prop_type == "POINTER":
+			value = getattr(struct, prop_id)
+			if value is None:
+				values.append(None)
+				continue
+			if value.bl_rna.identifier not in SIGNATURE_STRUCTS:
+				return None
+			value = get_struct_signature(value)
+			if value is None:
+				return None
+			values.append(value)
+	return tuple(values)
+
+
+# color_mapping isn't exported, so it shouldn't prevent sharing nodes
+SIGNATURE_SKIP_PROPS = {prop.identifier for prop in bpy.types.ShaderNode.bl_rna.properties}
+SIGNATURE_SKIP_PROPS.add("color_mapping")
+
+
+# returns None if the node can't be identified by its settings alone
+def get_node_signature(node):
+	defaults = []
+	for input in node.inputs:
+		if input.links:
+			return None
+		value = getattr(input, "default_value", None)
+		if hasattr(value, "__len__"):
+			value = tuple(value)
+		defaults.append(value)
+	settings = get_struct_signature(node, SIGNATURE_SKIP_PROPS)
+	if settings is None:
+		return None
+	# unlinked defaults are exported differently in normal map and bump
+	# contexts, so the same node there can't share the expression
+	return (node.bl_idname, get_context(), settings, tuple(defaults))
+
+
 group_context = {}
 
 
+# traversal state of the group node trees, keyed by tree and group inputs
+cached_groups = {}
+
+
+# expressions can be passed around as dicts, tuples or indices, this gets
+# a hashable (expression, OutputIndex) key that is the same for all of them.
+# shader sockets give dicts of expressions (BaseColor, Roughness...) instead,
+# these are keyed by each of their values
+def get_exp_key(expression):
+	if type(expression) is dict:
+		if "expression" not in expression:
+			return tuple(sorted((key, get_exp_key(value)) for key, value in expression.items()))
+		return (expression["expression"], expression.get("OutputIndex", 0))
+	elif type(expression) is int:
+		return (expression, 0)
+	elif type(expression) is list:
+		return tuple(get_exp_key(value) for value in expression)
+	return expression
+
+
 def exp_group(socket, exp_list):
 	node = socket.node
 	node_tree = node.node_tree
@@ -866,14 +1110,25 @@ def exp_group(socket, exp_list):
 
 	# capture group inputs to serve them to the group nodes
 	new_context = {}
+	context_key = []
 	for idx, input in enumerate(node.inputs):  # use input.identifier
 		value_has_links = len(input.links) > 0
 		value_exp = get_expression(input, exp_list, force_default=True)
 		new_context[input.identifier] = (value_exp, value_has_links)
+		context_key.append((get_exp_key(value_exp), value_has_links))
 
 	group_context = new_context
-	reverse_expressions = {}
-	cached_nodes = {}
+
+	# the inner graph only depends on the group inputs and the texture
+	# context (normal maps and bumps export textures differently), so the
+	# traversal state is shared by every output of this group node, and by
+	# other instances of the same group with the same inputs
+	group_key = (node_tree, get_context(), tuple(context_key))
+	group_state = cached_groups.get(group_key)
+	if group_state is None:
+		group_state = ({}, {})
+		cached_groups[group_key] = group_state
+	reverse_expressions, cached_nodes = group_state
 
 	# search for active output node inside the group node_tree:
 	output_node = None
@@ -1119,65 +1374,108 @@ USE_TEXCOORD_FLIP_Y = True
 MAT_FUNC_FLIPY = "/DatasmithBlenderContent/MaterialFunctions/FlipY"
 
 
+def exp_flip_y(expression, exp_list):
+	flip = Node("FunctionCall", {"Function": MAT_FUNC_FLIPY})
+	push_exp_input(flip, "0", expression)
+	return {"expression": exp_list.push(flip)}
+
+
+def exp_keep_y(expression, exp_list):
+	return expression
+
+
+# USE_TEXCOORD_FLIP_Y is fixed at load, so we pick the function once
+# instead of checking the flag for every texture coordinate
+exp_texcoord_flip = exp_flip_y if USE_TEXCOORD_FLIP_Y else exp_keep_y
+
+
 def exp_texcoord(exp_list, index=0, u_tiling=1.0, v_tiling=1.0):
+	# the uv chain is the same for every texture using the same channel, so
+	# we share it inside the material like the other constants
+	key = ("TextureCoordinate", index, u_tiling, v_tiling)
+	exp_idx = cached_constants.get(key)
+	if exp_idx is not None:
+		return {"expression": exp_idx}
+
 	uv = Node("TextureCoordinate")
 	uv["Index"] = index
 	uv["UTiling"] = u_tiling
 	uv["VTiling"] = v_tiling
 
-	exp_uv = exp_list.push(uv)
-
-	if USE_TEXCOORD_FLIP_Y:
-		flip = Node("FunctionCall", {"Function": MAT_FUNC_FLIPY})
-		push_exp_input(flip, "0", exp_uv)
-		exp_uv = exp_list.push(flip)
+	exp_uv = exp_texcoord_flip(exp_list.push(uv), exp_list)
 
 	pad = Node("AppendVector")
 	push_exp_input(pad, "0", exp_uv)
 	push_exp_input(pad, "1", exp_scalar(0, exp_list))
-	return {"expression": exp_list.push(pad)}
+	exp_idx = exp_list.push(pad)
+	cached_constants[key] = exp_idx
+	return {"expression": exp_idx}
+
+
+MAT_FUNC_TEXCOORD_GENERATED = "/DatasmithBlenderContent/MaterialFunctions/TexCoord_Generated"
+MAT_FUNC_LOCAL_POSITION = "/DatasmithBlenderContent/MaterialFunctions/BlenderLocalPosition"
+
+# tuples are (node_name, function_path), UV is handled by exp_texcoord
+TEXCOORD_OUTPUT_NODES = {
+	"Generated": ("FunctionCall", MAT_FUNC_TEXCOORD_GENERATED),
+	"Normal": ("VertexNormalWS", None),
+	"Object": ("FunctionCall", MAT_FUNC_LOCAL_POSITION),
+	"Camera": ("FunctionCall", "/DatasmithBlenderContent/MaterialFunctions/TexCoord_Camera"),
+	"Window": ("FunctionCall", "/DatasmithBlenderContent/MaterialFunctions/TexCoord_Window"),
+	"Reflection": ("ReflectionVectorWS", None),
+}
 
 
 @blender_node("TEX_COORD")
 def exp_texcoord_node(socket, exp_list):
 	socket_name = socket.name
-	if socket_name == "Generated":
-		output = Node("FunctionCall", {"Function": MAT_FUNC_TEXCOORD_GENERATED})
-		return {"expression": exp_list.push(output)}
-	if socket_name == "Normal":
-		output = Node("VertexNormalWS")
-		return {"expression": exp_list.push(output)}
 	if socket_name == "UV":
 		return exp_texcoord(exp_list)
-	if socket_name == "Object":
-		output = Node("FunctionCall", {"Function": op_custom_functions["LOCAL_POSITION"]})
-		return {"expression": exp_list.push(output)}
-	if socket_name == "Camera":
-		output = Node("FunctionCall", {"Function": "/DatasmithBlenderContent/MaterialFunctions/TexCoord_Camera"})
-		return {"expression": exp_list.push(output)}
-	if socket_name == "Window":
-		output = Node("FunctionCall", {"Function": "/DatasmithBlenderContent/MaterialFunctions/TexCoord_Window"})
-		return {"expression": exp_list.push(output)}
-	if socket_name == "Reflection":
-		output = Node("ReflectionVectorWS")
+	output_node = TEXCOORD_OUTPUT_NODES.get(socket_name)
+	if output_node:
+		node_name, function_path = output_node
+		output = Node(node_name)
+		if function_path:
+			output["Function"] = function_path
 		return {"expression": exp_list.push(output)}
 
 
+# maps uv layer names to the channel they get exported to, per mesh. reset
+# in collect_all_materials
+uv_channels_cache = {}
+
+
+def get_uv_channels(mesh):
+	uv_channels = uv_channels_cache.get(mesh)
+	if uv_channels is None:
+		# this needs to match the channel order of the mesh export: only the
+		# first 8 layers are written, and the active_render layer is swapped
+		# with the first one
+		uv_layers = mesh.uv_layers[:8]
+		uv_channels = {uv.name: idx for idx, uv in enumerate(uv_layers)}
+		for idx, uv in enumerate(uv_layers):
+			if uv.active_render and idx != 0:
+				uv_channels[uv.name] = 0
+				uv_channels[uv_layers[0].name] = idx
+		uv_channels_cache[mesh] = uv_channels
+	return uv_channels
+
+
 @blender_node("UVMAP")
 def exp_uvmap(socket, exp_list):
 	uv_index = 0
+	uv_map = socket.node.uv_map
 	m = material_owner.data
-	if type(m) is bpy.types.Mesh:
-		for idx, uv in enumerate(m.uv_layers):
-			if uv.name == id:
-				uv_index = idx
+	# an empty uv_map uses the active_render layer, which is always channel 0
+	if uv_map and type(m) is bpy.types.Mesh:
+		uv_index = get_uv_channels(m).get(uv_map, 0)
 	return exp_texcoord(exp_list, uv_index)
 
 
 @blender_node("VALUE")
 def exp_value(socket, exp_list):
 	node_value = socket.default_value
-	n = Node("Scalar", {"constant": "%f" % node_value})
+	n = Node("Scalar", {"constant": SCALAR_FORMAT(node_value)})
 	if socket.node.label:
 		n["Name"] = socket.node.label
 	return {"expression": exp_list.push(n)}
@@ -1192,18 +1490,23 @@ def exp_wireframe(socket, exp_list):
 # Add > Texture
 
 
-MAT_FUNC_TEXCOORD_GENERATED = "/DatasmithBlenderContent/MaterialFunctions/TexCoord_Generated"
-
-
 def exp_texcoord_generated(exp_list):
 	# this function is used as a generator for default inputs in some tex nodes
 	n = Node("FunctionCall", {"Function": MAT_FUNC_TEXCOORD_GENERATED})
 	return {"expression": exp_list.push(n)}
 
 
-VEC_ZERO = Vector()
-ROT_ZERO = Euler()
-VEC_ONE = Vector((1, 1, 1))
+# plain tuples, so comparing against the mapping values doesn't go through
+# mathutils types
+VEC_ZERO = (0.0, 0.0, 0.0)
+ROT_ZERO = (0.0, 0.0, 0.0)
+VEC_ONE = (1.0, 1.0, 1.0)
+MAPPING_IDENTITY = (VEC_ZERO, ROT_ZERO, VEC_ONE)
+
+# mapped expressions are shared inside a material when different texture
+# nodes use the same input and the same texture mapping. gets reset in
+# collect_pbr_material
+cached_mappings = {}
 
 
 # the generator param is a function that receives the exp_list and returns
@@ -1216,13 +1519,43 @@ def get_expression_mapped(socket, exp_list, generator, force_exp=False):
 	if len(socket.links) != 0:
 		result_exp = get_expression(socket, exp_list)
 
-	if result_exp is None and force_exp:
-		result_exp = generator(exp_list)
 	node = socket.node
 	mapping = node.texture_mapping
 	mapping_axes = (mapping.mapping_x, mapping.mapping_y, mapping.mapping_z)
-	base_axes = ("X", "Y", "Z")
-	if mapping_axes != base_axes:
+	mapping_transform = (tuple(mapping.translation), tuple(mapping.rotation), tuple(mapping.scale))
+
+	# the usual case is an identity mapping, which doesn't wrap the input so
+	# there is nothing to build or cache, unless we have to generate it
+	if mapping_axes == MAPPING_BASE_AXES and mapping_transform == MAPPING_IDENTITY:
+		if result_exp is not None or not force_exp:
+			return result_exp
+
+	mapping_key = (mapping_axes, mapping_transform, mapping.vector_type)
+
+	# unlinked sockets are keyed by their generator, as it would create the
+	# same expression for both
+	input_key = (generator, force_exp)
+	if result_exp is not None:
+		input_key = get_exp_key(result_exp)
+
+	cache_key = (input_key, mapping_key)
+	if cache_key in cached_mappings:
+		return cached_mappings[cache_key]
+
+	result_exp = get_expression_mapped_inner(result_exp, exp_list, generator, force_exp, mapping, mapping_axes, mapping_transform)
+	cached_mappings[cache_key] = result_exp
+	return result_exp
+
+
+MAPPING_BASE_AXES = ("X", "Y", "Z")
+# mapping axes can also be NONE, which leaves that component unconnected
+MAPPING_AXIS_INDEX = {"X": 0, "Y": 1, "Z": 2}
+
+
+def get_expression_mapped_inner(result_exp, exp_list, generator, force_exp, mapping, mapping_axes, mapping_transform):
+	if result_exp is None and force_exp:
+		result_exp = generator(exp_list)
+	if mapping_axes != MAPPING_BASE_AXES:
 		if not result_exp:
 			result_exp = generator(exp_list)
 
@@ -1231,14 +1564,14 @@ def get_expression_mapped(socket, exp_list, generator, force_exp=False):
 		node_break_exp = exp_list.push(node_break)
 
 		node_make = Node("FunctionCall", {"Function": MAT_FUNC_MAKE_FLOAT3})
-		for idx in range(3):
-			if mapping_axes[idx] in base_axes:
-				target_idx = base_axes.index(mapping_axes[idx])
+		for idx, axis in enumerate(mapping_axes):
+			target_idx = MAPPING_AXIS_INDEX.get(axis)
+			if target_idx is not None:
 				push_exp_input(node_make, idx, (node_break_exp, target_idx))
 
 		result_exp = {"expression": exp_list.push(node_make)}
 
-	tx_loc, tx_rot, tx_scale = (mapping.translation, mapping.rotation, mapping.scale)
+	tx_loc, tx_rot, tx_scale = mapping_transform
 	if tx_loc != VEC_ZERO or tx_rot != ROT_ZERO or tx_scale != VEC_ONE:
 		if not result_exp:
 			result_exp = generator(exp_list)
@@ -1257,11 +1590,12 @@ def get_expression_mapped(socket, exp_list, generator, force_exp=False):
 	return result_exp
 
 
+# function suffix, and whether the texture takes Vector and W inputs
 tex_dimensions_map = {
-	"1D": "1d",
-	"2D": "2d",
-	"3D": "3d",
-	"4D": "4d",
+	"1D": ("1d", False, True),
+	"2D": ("2d", True, False),
+	"3D": ("3d", True, False),
+	"4D": ("4d", True, True),
 }
 
 
@@ -1272,22 +1606,13 @@ def exp_tex_brick(socket, exp_list):
 	function_path = "/DatasmithBlenderContent/MaterialFunctions/TexBrick"
 	n = Node("FunctionCall", {"Function": function_path})
 
-	inputs = node.inputs
-	vector_exp = get_expression_mapped(inputs["Vector"], exp_list, exp_texcoord_generated)
-	push_exp_input(n, "0", vector_exp)
-	push_exp_input(n, "1", get_expression(inputs["Color1"], exp_list))
-	push_exp_input(n, "2", get_expression(inputs["Color2"], exp_list))
-	push_exp_input(n, "3", get_expression(inputs["Mortar"], exp_list))
-	push_exp_input(n, "4", get_expression(inputs["Scale"], exp_list))
-	push_exp_input(n, "5", get_expression(inputs["Mortar Size"], exp_list))
-	push_exp_input(n, "6", get_expression(inputs["Mortar Smooth"], exp_list))
-	push_exp_input(n, "7", get_expression(inputs["Bias"], exp_list))
-	push_exp_input(n, "8", get_expression(inputs["Brick Width"], exp_list))
-	push_exp_input(n, "9", get_expression(inputs["Row Height"], exp_list))
-	push_exp_input(n, "10", exp_scalar(node.offset, exp_list))
-	push_exp_input(n, "11", exp_scalar(node.offset_frequency, exp_list))
-	push_exp_input(n, "12", exp_scalar(node.squash, exp_list))
-	push_exp_input(n, "13", exp_scalar(node.squash_frequency, exp_list))
+	inputs = get_named_inputs(node)
+	expressions = [get_expression_mapped(inputs["Vector"], exp_list, exp_texcoord_generated)]
+	for input_name in ("Color1", "Color2", "Mortar", "Scale", "Mortar Size", "Mortar Smooth", "Bias", "Brick Width", "Row Height"):
+		expressions.append(get_expression(inputs[input_name], exp_list))
+	for value in (node.offset, node.offset_frequency, node.squash, node.squash_frequency):
+		expressions.append(exp_scalar(value, exp_list))
+	push_exp_inputs(n, expressions)
 
 	exp_idx = exp_list.push(n)
 	NODE_TEX_BRICK_OUTPUTS = ("Color", "Fac")
@@ -1303,10 +1628,15 @@ def exp_tex_checker(socket, exp_list):
 	inputs = node.inputs
 	n = Node("FunctionCall", {"Function": "/DatasmithBlenderContent/MaterialFunctions/TexChecker"})
 	vector_exp = get_expression_mapped(inputs["Vector"], exp_list, exp_texcoord_generated)
-	push_exp_input(n, "0", vector_exp)
-	push_exp_input(n, "1", get_expression(inputs["Color1"], exp_list))
-	push_exp_input(n, "2", get_expression(inputs["Color2"], exp_list))
-	push_exp_input(n, "3", get_expression(inputs["Scale"], exp_list))
+	push_exp_inputs(
+		n,
+		(
+			vector_exp,
+			get_expression(inputs["Color1"], exp_list),
+			get_expression(inputs["Color2"], exp_list),
+			get_expression(inputs["Scale"], exp_list),
+		),
+	)
 
 	exp_idx = exp_list.push(n)
 	NODE_TEX_CHECKER_OUTPUTS = ("Color", "Fac")
@@ -1345,6 +1675,15 @@ def exp_tex_gradient(socket, exp_list):
 	return exp_from_cache(cached_node, socket.name)
 
 
+# tuples are (node_name, function_path)
+TEX_IMAGE_PROJECTION_NODES = {
+	"FLAT": ("ComponentMask", None),
+	"BOX": ("FunctionCall", "/DatasmithBlenderContent/MaterialFunctions/TexImage_ProjBox"),
+	"SPHERE": ("FunctionCall", "/DatasmithBlenderContent/MaterialFunctions/TexImage_ProjSphere"),
+	"TUBE": ("FunctionCall", "/DatasmithBlenderContent/MaterialFunctions/TexImage_ProjTube"),
+}
+
+
 @blender_node("TEX_IMAGE")
 def exp_tex_image(socket, exp_list):
 	node = socket.node
@@ -1370,26 +1709,20 @@ def exp_tex_image(socket, exp_list):
 
 	tex_coord_exp = None
 	if tex_coord:
-		proj = None
-		if node.projection == "FLAT":
-			proj = Node("ComponentMask")
-		elif node.projection == "BOX":
-			proj = Node("FunctionCall", {"Function": "/DatasmithBlenderContent/MaterialFunctions/TexImage_ProjBox"})
-		elif node.projection == "SPHERE":
-			proj = Node("FunctionCall", {"Function": "/DatasmithBlenderContent/MaterialFunctions/TexImage_ProjSphere"})
-		elif node.projection == "TUBE":
-			proj = Node("FunctionCall", {"Function": "/DatasmithBlenderContent/MaterialFunctions/TexImage_ProjTube"})
+		projection = TEX_IMAGE_PROJECTION_NODES.get(node.projection)
+		if projection:
+			proj_name, proj_function = projection
+			proj = Node(proj_name)
+			if proj_function:
+				proj["Function"] = proj_function
+			push_exp_input(proj, "0", tex_coord)
+			tex_coord_exp = {"expression": exp_list.push(proj)}
 		else:
 			log.error("node TEX_IMAGE has unhandled projection: %s" % node.projection)
-
-		push_exp_input(proj, "0", tex_coord)
-		tex_coord_exp = {"expression": exp_list.push(proj)}
+			tex_coord_exp = tex_coord
 
 	if tex_coord_exp:
-		if USE_TEXCOORD_FLIP_Y:
-			flip = Node("FunctionCall", {"Function": MAT_FUNC_FLIPY})
-			push_exp_input(flip, "0", tex_coord_exp)
-			tex_coord_exp = {"expression": exp_list.push(flip)}
+		tex_coord_exp = exp_texcoord_flip(tex_coord_exp, exp_list)
 
 		texture_exp.push(Node("Coordinates", tex_coord_exp))
 
@@ -1418,12 +1751,17 @@ def exp_tex_magic(socket, exp_list):
 	function_path = "/DatasmithBlenderContent/MaterialFunctions/TexMagic"
 	n = Node("FunctionCall", {"Function": function_path})
 
-	inputs = node.inputs
+	inputs = get_named_inputs(node)
 	vector_exp = get_expression_mapped(inputs["Vector"], exp_list, exp_texcoord_generated)
-	push_exp_input(n, "0", vector_exp)
-	push_exp_input(n, "1", get_expression(inputs["Scale"], exp_list))
-	push_exp_input(n, "2", get_expression(inputs["Distortion"], exp_list))
-	push_exp_input(n, "3", exp_scalar(node.turbulence_depth, exp_list))
+	push_exp_inputs(
+		n,
+		(
+			vector_exp,
+			get_expression(inputs["Scale"], exp_list),
+			get_expression(inputs["Distortion"], exp_list),
+			exp_scalar(node.turbulence_depth, exp_list),
+		),
+	)
 
 	exp_idx = exp_list.push(n)
 	NODE_TEX_MAGIC_OUTPUTS = ("Color", "Fac")
@@ -1446,7 +1784,7 @@ def exp_tex_musgrave(socket, exp_list):
 	node = socket.node
 
 	musgrave_type = tex_musgrave_type_map[node.musgrave_type]
-	dimensions = tex_dimensions_map[node.musgrave_dimensions]
+	dimensions, use_vector, use_w = tex_dimensions_map[node.musgrave_dimensions]
 	function_name = "node_tex_musgrave_%s_%s" % (musgrave_type, dimensions)
 
 	n = Node(
@@ -1464,7 +1802,7 @@ def exp_tex_musgrave(socket, exp_list):
 	arguments = []
 	arguments2 = []
 
-	inputs = node.inputs
+	inputs = get_named_inputs(node)
 
 	def add_param(param_name, cond=True):
 		if cond:
@@ -1475,7 +1813,6 @@ def exp_tex_musgrave(socket, exp_list):
 		else:
 			arguments.append("0")
 
-	use_vector = dimensions != "1d"
 	if use_vector:
 		vector_exp = get_expression_mapped(inputs["Vector"], exp_list, exp_texcoord_generated, force_exp=True)
 		push_exp_input(n, "0", vector_exp)
@@ -1484,7 +1821,6 @@ def exp_tex_musgrave(socket, exp_list):
 	else:
 		arguments.append("0")
 
-	use_w = dimensions == "1d" or dimensions == "4d"
 	add_param("W", cond=use_w)
 
 	add_param("Scale")
@@ -1498,16 +1834,16 @@ def exp_tex_musgrave(socket, exp_list):
 	use_gain = musgrave_type in ("ridged_multi_fractal", "hybrid_multi_fractal")
 	add_param("Gain", cond=use_gain)
 
-	for idx, arg in enumerate(arguments2):
-		n.push(Node("Arg", {"index": idx, "name": arg[0]}))
-
-	for idx, arg in enumerate(arguments2):
-		n.push(exp_input(idx, arg[1]))
+	arg_nodes = []
+	input_nodes = []
+	for idx, (arg_name, arg_exp) in enumerate(arguments2):
+		arg_nodes.append(Node("Arg", {"index": idx, "name": arg_name}))
+		input_nodes.append(exp_input(idx, arg_exp))
+	n.children.extend(arg_nodes)
+	n.children.extend(input_nodes)
 
 	assert len(arguments) == 8
-	func_params = ", ".join(arguments)
-
-	code = "float r; %s(%s, r); return r;" % (function_name, func_params)
+	code = "float r; %s(%s, r); return r;" % (function_name, ", ".join(arguments))
 
 	n.push(Node("Code", children=[code]))
 
@@ -1517,13 +1853,13 @@ def exp_tex_musgrave(socket, exp_list):
 @blender_node("TEX_NOISE")
 def exp_tex_noise(socket, exp_list):
 	node = socket.node
-	dimensions = tex_dimensions_map[node.noise_dimensions]
+	dimensions, use_vector, use_w = tex_dimensions_map[node.noise_dimensions]
 
 	function_path = "/DatasmithBlenderContent/MaterialFunctions/TexNoise_%s" % dimensions
 	n = Node("FunctionCall", {"Function": function_path})
 
 	input_idx = 0
-	inputs = node.inputs
+	inputs = get_named_inputs(node)
 
 	def push_input(name):
 		nonlocal input_idx
@@ -1532,11 +1868,11 @@ def exp_tex_noise(socket, exp_list):
 		push_exp_input(n, input_idx, exp)
 		input_idx += 1
 
-	if dimensions != "1d":
+	if use_vector:
 		vector_exp = get_expression_mapped(inputs["Vector"], exp_list, exp_texcoord_generated, force_exp=True)
 		push_exp_input(n, input_idx, vector_exp)
 		input_idx += 1
-	if dimensions == "1d" or dimensions == "4d":
+	if use_w:
 		push_input("W")
 
 	push_input("Scale")
@@ -1577,7 +1913,7 @@ tex_voronoi_type_map = {
 @blender_node("TEX_VORONOI")
 def exp_tex_voronoi(socket, exp_list):
 	node = socket.node
-	dimensions = tex_dimensions_map[node.voronoi_dimensions]
+	dimensions, use_vector, use_w = tex_dimensions_map[node.voronoi_dimensions]
 	voronoi_type = node.feature
 	voronoi_type_fn = tex_voronoi_type_map[voronoi_type]
 
@@ -1585,7 +1921,7 @@ def exp_tex_voronoi(socket, exp_list):
 	n = Node("FunctionCall", {"Function": function_path})
 
 	input_idx = 0
-	inputs = node.inputs
+	inputs = get_named_inputs(node)
 
 	def push_input(name):
 		nonlocal input_idx
@@ -1594,11 +1930,11 @@ def exp_tex_voronoi(socket, exp_list):
 		push_exp_input(n, input_idx, exp)
 		input_idx += 1
 
-	if dimensions != "1d":
+	if use_vector:
 		vector_exp = get_expression_mapped(inputs["Vector"], exp_list, exp_texcoord_generated, force_exp=True)
 		push_exp_input(n, "0", vector_exp)
 		input_idx += 1
-	if dimensions == "1d" or dimensions == "4d":
+	if use_w:
 		push_input("W")
 
 	push_input("Scale")
@@ -1606,7 +1942,7 @@ def exp_tex_voronoi(socket, exp_list):
 	if voronoi_type == "SMOOTH_F1":
 		push_input("Smoothness")
 
-	use_metric = (dimensions != "1d") and (voronoi_type not in ("DISTANCE_TO_EDGE", "N_SPHERE_RADIUS"))
+	use_metric = use_vector and (voronoi_type not in ("DISTANCE_TO_EDGE", "N_SPHERE_RADIUS"))
 	metric = node.distance
 	if use_metric:
 		if metric == "MINKOWSKI":
@@ -1626,10 +1962,10 @@ def exp_tex_voronoi(socket, exp_list):
 	elif voronoi_type == "N_SPHERE_RADIUS":
 		NODE_TEX_VORONOI_OUTPUTS = ("Radius",)
 	else:
-		if dimensions == "1d":
+		if not use_vector:
 			NODE_TEX_VORONOI_OUTPUTS = ("Distance", "Color", "W")
 		else:
-			if dimensions != "4d":
+			if not use_w:
 				NODE_TEX_VORONOI_OUTPUTS = ("Distance", "Color", "Position")
 			else:
 				NODE_TEX_VORONOI_OUTPUTS = ("Distance", "Color", "Position", "W")
@@ -1658,18 +1994,13 @@ def exp_tex_wave(socket, exp_list):
 	function_path = "/DatasmithBlenderContent/MaterialFunctions/TexWave"
 	n = Node("FunctionCall", {"Function": function_path})
 
-	inputs = node.inputs
-	vector_exp = get_expression_mapped(inputs["Vector"], exp_list, exp_texcoord_generated)
-	push_exp_input(n, "0", vector_exp)
-	push_exp_input(n, "1", get_expression(inputs["Scale"], exp_list))
-	push_exp_input(n, "2", get_expression(inputs["Distortion"], exp_list))
-	push_exp_input(n, "3", get_expression(inputs["Detail"], exp_list))
-	push_exp_input(n, "4", get_expression(inputs["Detail Scale"], exp_list))
-	push_exp_input(n, "5", get_expression(inputs["Detail Roughness"], exp_list))
-	push_exp_input(n, "6", get_expression(inputs["Phase Offset"], exp_list))
-	push_exp_input(n, "7", exp_scalar(wave_type_val, exp_list))
-	push_exp_input(n, "8", exp_scalar(direction_val, exp_list))
-	push_exp_input(n, "9", exp_scalar(profile_val, exp_list))
+	inputs = get_named_inputs(node)
+	expressions = [get_expression_mapped(inputs["Vector"], exp_list, exp_texcoord_generated)]
+	for input_name in ("Scale", "Distortion", "Detail", "Detail Scale", "Detail Roughness", "Phase Offset"):
+		expressions.append(get_expression(inputs[input_name], exp_list))
+	for value in (wave_type_val, direction_val, profile_val):
+		expressions.append(exp_scalar(value, exp_list))
+	push_exp_inputs(n, expressions)
 
 	exp_idx = exp_list.push(n)
 	NODE_TEX_WAVE_OUTPUTS = ("Color", "Fac")
@@ -1681,7 +2012,7 @@ def exp_tex_wave(socket, exp_list):
 @blender_node("TEX_WHITE_NOISE")
 def exp_tex_white_noise(socket, exp_list):
 	node = socket.node
-	dimensions = tex_dimensions_map[node.noise_dimensions]
+	dimensions, use_vector, use_w = tex_dimensions_map[node.noise_dimensions]
 
 	function_path = "/DatasmithBlenderContent/MaterialFunctions/TexWhiteNoise_%s" % dimensions
 	n = Node("FunctionCall", {"Function": function_path})
@@ -1689,11 +2020,11 @@ def exp_tex_white_noise(socket, exp_list):
 	input_idx = 0
 	inputs = node.inputs
 
-	if dimensions != "1d":
+	if use_vector:
 		exp = get_expression(inputs["Vector"], exp_list, skip_default_warn=True)
 		push_exp_input(n, input_idx, exp)
 		input_idx += 1
-	if dimensions == "1d" or dimensions == "4d":
+	if use_w:
 		exp = get_expression(inputs["W"], exp_list, skip_default_warn=True)
 		push_exp_input(n, input_idx, exp)
 
@@ -1714,7 +2045,7 @@ op_custom_functions = {
 	"FRESNEL": "/DatasmithBlenderContent/MaterialFunctions/BlenderFresnel",
 	"HUE_SAT": "/DatasmithBlenderContent/MaterialFunctions/AdjustHSV",
 	"LAYER_WEIGHT": "/DatasmithBlenderContent/MaterialFunctions/LayerWeight",
-	"LOCAL_POSITION": "/DatasmithBlenderContent/MaterialFunctions/BlenderLocalPosition",
+	"LOCAL_POSITION": MAT_FUNC_LOCAL_POSITION,
 	"NORMAL_FROM_HEIGHT": "/Engine/Functions/Engine_MaterialFunctions03/Procedurals/NormalFromHeightmap",
 }
 
@@ -1722,11 +2053,9 @@ op_custom_functions = {
 @blender_node("BRIGHTCONTRAST")
 def exp_bright_contrast(socket, exp_list):
 	node = socket.node
-	n = Node("FunctionCall", {"Function": op_custom_functions["BRIGHTCONTRAST"]})
-	for idx, socket_name in enumerate(("Color", "Bright", "Contrast")):
-		input_expression = get_expression(node.inputs[socket_name], exp_list)
-		n.push(exp_input(idx, input_expression))
-	return {"expression": exp_list.push(n)}
+	inputs = node.inputs
+	exp_inputs = [exp_input(idx, get_expression(inputs[socket_name], exp_list)) for idx, socket_name in enumerate(("Color", "Bright", "Contrast"))]
+	return {"expression": exp_cached_function_call(op_custom_functions["BRIGHTCONTRAST"], exp_inputs, exp_list)}
 
 
 @blender_node("GAMMA")
@@ -1743,18 +2072,10 @@ def exp_gamma(socket, exp_list):
 @blender_node("HUE_SAT")
 def exp_hsv(socket, exp_list):
 	node = socket.node
-	n = Node("FunctionCall", {"Function": op_custom_functions["HUE_SAT"]})
-	exp_hue = get_expression(node.inputs["Hue"], exp_list)
-	n.push(exp_input("0", exp_hue))
-	exp_sat = get_expression(node.inputs["Saturation"], exp_list)
-	n.push(exp_input("1", exp_sat))
-	exp_value = get_expression(node.inputs["Value"], exp_list)
-	n.push(exp_input("2", exp_value))
-	exp_fac = get_expression(node.inputs["Fac"], exp_list)
-	n.push(exp_input("3", exp_fac))
-	exp_color = get_expression(node.inputs["Color"], exp_list)
-	n.push(exp_input("4", exp_color))
-	return {"expression": exp_list.push(n), "OutputIndex": 0}
+	inputs = get_named_inputs(node)
+	input_names = ("Hue", "Saturation", "Value", "Fac", "Color")
+	exp_inputs = [exp_input(idx, get_expression(inputs[input_name], exp_list)) for idx, input_name in enumerate(input_names)]
+	return {"expression": exp_cached_function_call(op_custom_functions["HUE_SAT"], exp_inputs, exp_list), "OutputIndex": 0}
 
 
 @blender_node("INVERT")
@@ -1811,23 +2132,15 @@ def exp_mixrgb(socket, exp_list):
 	exp_t = get_expression(inputs["Fac"], exp_list)
 	# blender did always clamp factor input for color blends
 	# doesn't do it forcefully in new mix node because it is optional
-	t_clamped = Node("Saturate")
-	push_exp_input(t_clamped, 0, exp_t)
-	exp_t2 = exp_list.push(t_clamped)
+	exp_t2 = exp_saturate(exp_t, exp_list)
 
 	exp_a = get_expression(inputs["Color1"], exp_list)
 	exp_b = get_expression(inputs["Color2"], exp_list)
 
-	blend = Node("FunctionCall", {"Function": op_map_blend[node.blend_type]})
-	push_exp_input(blend, 0, exp_t2)
-	push_exp_input(blend, 1, exp_a)
-	push_exp_input(blend, 2, exp_b)
-	exp_blend = exp_list.push(blend)
+	exp_blend = exp_cached_function_call(op_map_blend[node.blend_type], get_exp_inputs((exp_t2, exp_a, exp_b)), exp_list)
 
 	if node.use_clamp:
-		clamp = Node("Saturate")
-		push_exp_input(clamp, "0", exp_blend)
-		exp_blend = exp_list.push(clamp)
+		exp_blend = exp_saturate(exp_blend, exp_list)
 
 	return {"expression": exp_blend, "OutputIndex": 0}
 
@@ -1864,10 +2177,7 @@ def exp_curvergb(socket, exp_list):
 	texture = exp_texture_object(BLENDER_CURVES_NAME, exp_list)
 
 	lookup = Node("FunctionCall", {"Function": op_custom_functions["CURVE_RGB"]})
-	lookup.push(exp_input("0", color))
-	lookup.push(exp_input("1", curve_idx))
-	lookup.push(exp_input("2", vertical_res))
-	lookup.push(exp_input("3", texture))
+	push_exp_inputs(lookup, (color, curve_idx, vertical_res, texture))
 	blend_exp = exp_list.push(lookup)
 
 	blend = Node("LinearInterpolate")
@@ -1885,20 +2195,17 @@ def exp_curvergb(socket, exp_list):
 def exp_bump(socket, exp_list):
 	node = socket.node
 	MAT_FUNC_BUMP = "/DatasmithBlenderContent/MaterialFunctions/Bump"
-	bump_node = Node("FunctionCall", {"Function": MAT_FUNC_BUMP})
 
-	exp_invert = exp_scalar(-1 if node.invert else 1, exp_list)
-	push_exp_input(bump_node, "0", exp_invert)
+	expressions = [exp_scalar(-1 if node.invert else 1, exp_list)]
 
 	push_texture_context(MAT_CTX_BUMP)
 	inputs = node.inputs
-	push_exp_input(bump_node, "1", get_expression(inputs["Strength"], exp_list))
-	push_exp_input(bump_node, "2", get_expression(inputs["Distance"], exp_list))
-	push_exp_input(bump_node, "3", get_expression(inputs["Height"], exp_list))
+	for input_name in ("Strength", "Distance", "Height"):
+		expressions.append(get_expression(inputs[input_name], exp_list))
 	pop_texture_context()
 
-	push_exp_input(bump_node, "4", get_expression(inputs["Normal"], exp_list, skip_default_warn=True))
-	return {"expression": exp_list.push(bump_node)}
+	expressions.append(get_expression(inputs["Normal"], exp_list, skip_default_warn=True))
+	return {"expression": exp_cached_function_call(MAT_FUNC_BUMP, get_exp_inputs(expressions), exp_list)}
 
 
 MAT_FUNC_MAPPINGS = {
@@ -1935,8 +2242,7 @@ def exp_mapping(socket, exp_list):
 def exp_normal(socket, exp_list):
 	node = socket.node
 	n = Node("FunctionCall", {"Function": "/DatasmithBlenderContent/MaterialFunctions/Normal"})
-	push_exp_input(n, "0", exp_vector(node.outputs[0].default_value, exp_list))
-	push_exp_input(n, "1", get_expression(node.inputs[0], exp_list))
+	push_exp_inputs(n, (exp_vector(node.outputs[0].default_value, exp_list), get_expression(node.inputs[0], exp_list)))
 	exp = exp_list.push(n)
 
 	NODE_NORMAL_OUTPUTS = ("Normal", "Dot")
@@ -1959,8 +2265,7 @@ def exp_normal_map(socket, exp_list):
 	pop_texture_context()
 
 	node_strength = Node("FunctionCall", {"Function": "/DatasmithBlenderContent/MaterialFunctions/NormalStrength"})
-	push_exp_input(node_strength, "0", exp_strength)
-	push_exp_input(node_strength, "1", exp_color)
+	push_exp_inputs(node_strength, (exp_strength, exp_color))
 	return {"expression": exp_list.push(node_strength)}
 
 
@@ -2095,10 +2400,7 @@ def exp_color_ramp(socket, exp_list):
 	texture = exp_texture_object(BLENDER_CURVES_NAME, exp_list)
 
 	lookup = Node("FunctionCall", {"Function": op_custom_functions["COLOR_RAMP"]})
-	lookup.push(exp_input("0", level))
-	lookup.push(exp_input("1", curve_idx))
-	lookup.push(exp_input("2", vertical_res))
-	lookup.push(exp_input("3", texture))
+	push_exp_inputs(lookup, (level, curve_idx, vertical_res, texture))
 	result = exp_list.push(lookup)
 	return {"expression": result, "OutputIndex": 0}
 
@@ -2110,9 +2412,7 @@ MAT_FUNC_MAKE_FLOAT3 = "/Engine/Functions/Engine_MaterialFunctions02/Utility/Mak
 def exp_make_vec3(socket, exp_list):
 	node = socket.node
 	output = Node("FunctionCall", {"Function": MAT_FUNC_MAKE_FLOAT3})
-	output.push(exp_input("0", get_expression(node.inputs[0], exp_list)))
-	output.push(exp_input("1", get_expression(node.inputs[1], exp_list)))
-	output.push(exp_input("2", get_expression(node.inputs[2], exp_list)))
+	output.children = [exp_input(idx, get_expression(input, exp_list)) for idx, input in enumerate(node.inputs[:3])]
 	return {"expression": exp_list.push(output)}
 
 
@@ -2123,9 +2423,7 @@ MAT_FUNC_COMBINE_RGB = "/DatasmithBlenderContent/MaterialFunctions/CombineRGB"
 def exp_combine_rgb(socket, exp_list):
 	node = socket.node
 	output = Node("FunctionCall", {"Function": MAT_FUNC_COMBINE_RGB})
-	output.push(exp_input("0", get_expression(node.inputs[0], exp_list)))
-	output.push(exp_input("1", get_expression(node.inputs[1], exp_list)))
-	output.push(exp_input("2", get_expression(node.inputs[2], exp_list)))
+	output.children = [exp_input(idx, get_expression(input, exp_list)) for idx, input in enumerate(node.inputs[:3])]
 	return {"expression": exp_list.push(output)}
 
 
@@ -2136,9 +2434,7 @@ MAT_FUNC_HSV_TO_RGB = "/DatasmithBlenderContent/MaterialFunctions/HSV_To_RGB"
 def exp_make_hsv(socket, exp_list):
 	inputs = socket.node.inputs
 	output = Node("FunctionCall", {"Function": MAT_FUNC_HSV_TO_RGB})
-	push_exp_input(output, "0", get_expression(inputs[0], exp_list))
-	push_exp_input(output, "1", get_expression(inputs[1], exp_list))
-	push_exp_input(output, "2", get_expression(inputs[2], exp_list))
+	push_exp_inputs(output, [get_expression(input, exp_list) for input in inputs[:3]])
 	return {"expression": exp_list.push(output)}
 
 
@@ -2155,9 +2451,7 @@ def exp_combine_color(socket, exp_list):
 	func_path = NODE_COMBINE_COLOR_MAP[node.mode]
 	output = Node("FunctionCall", {"Function": func_path})
 	inputs = node.inputs
-	push_exp_input(output, "0", get_expression(inputs[0], exp_list))
-	push_exp_input(output, "1", get_expression(inputs[1], exp_list))
-	push_exp_input(output, "2", get_expression(inputs[2], exp_list))
+	push_exp_inputs(output, [get_expression(input, exp_list) for input in inputs[:3]])
 	return {"expression": exp_list.push(output)}
 
 
@@ -2255,6 +2549,7 @@ MAT_FUNC_MAPRANGE_SMOOTHERSTEP = "/DatasmithBlenderContent/MaterialFunctions/Map
 @blender_node("MAP_RANGE")
 def exp_map_range(socket, exp_list):
 	node = socket.node
+	inputs = get_named_inputs(node)
 	interpolation_type = node.interpolation_type
 	func_path = None
 	if interpolation_type == "LINEAR":
@@ -2274,22 +2569,12 @@ def exp_map_range(socket, exp_list):
 
 	assert func_path
 
-	value = get_expression(node.inputs["Value"], exp_list)
-	from_min = get_expression(node.inputs["From Min"], exp_list)
-	from_max = get_expression(node.inputs["From Max"], exp_list)
-	to_min = get_expression(node.inputs["To Min"], exp_list)
-	to_max = get_expression(node.inputs["To Max"], exp_list)
+	input_names = ("Value", "From Min", "From Max", "To Min", "To Max")
+	if interpolation_type == "STEPPED":
+		input_names += ("Steps",)
 
 	n = Node("FunctionCall", {"Function": func_path})
-	n.push(exp_input("0", value))
-	n.push(exp_input("1", from_min))
-	n.push(exp_input("2", from_max))
-	n.push(exp_input("3", to_min))
-	n.push(exp_input("4", to_max))
-
-	if interpolation_type == "STEPPED":
-		steps = get_expression(node.inputs["Steps"], exp_list)
-		n.push(exp_input("5", steps))
+	n.children = [exp_input(idx, get_expression(inputs[input_name], exp_list)) for idx, input_name in enumerate(input_names)]
 
 	return {"expression": exp_list.push(n)}
 
@@ -2303,12 +2588,12 @@ def exp_generic(name, inputs, exp_list, force_default=False):
 
 
 def exp_function_call(path, inputs, exp_list, force_default=False):
-	n = Node("FunctionCall", {"Function": path})
+	exp_inputs = []
 	if inputs:
 		for idx, input in enumerate(inputs):
 			input_exp = get_expression(input, exp_list, force_default)
-			n.push(exp_input(idx, input_exp))
-	return {"expression": exp_list.push(n)}
+			exp_inputs.append(exp_input(idx, input_exp))
+	return {"expression": exp_cached_function_call(path, exp_inputs, exp_list)}
 
 
 MATH_CUSTOM_FUNCTIONS = {
@@ -2367,33 +2652,43 @@ MATH_CUSTOM_IMPL = {
 }
 
 
+# single lookup table for exp_math, built from the tables above
+# values are (kind, input_count, name_or_path)
+MATH_KIND_NODE = 0
+MATH_KIND_FUNCTION = 1
+MATH_KIND_CUSTOM = 2
+MATH_OPERATIONS = {
+	**{op: (MATH_KIND_NODE, 2, name) for op, name in MATH_TWO_INPUTS.items()},
+	**{op: (MATH_KIND_NODE, 1, name) for op, name in MATH_ONE_INPUT.items()},
+	**{op: (MATH_KIND_FUNCTION, size, path) for op, (size, path) in MATH_CUSTOM_FUNCTIONS.items()},
+	**{op: (MATH_KIND_CUSTOM, 0, None) for op in MATH_CUSTOM_IMPL},
+}
+
+
+# unreal If expressions consider A == B when the difference is within this
+IF_EQUALS_THRESHOLD = 0.00001
+
+
 @blender_node("MATH")
 def exp_math(socket, exp_list):
 	node = socket.node
 	op = node.operation
 	exp = None
-	if op in MATH_TWO_INPUTS:
-		exp = exp_generic(
-			name=MATH_TWO_INPUTS[op],
-			inputs=node.inputs[:2],
-			exp_list=exp_list,
-			force_default=True,
-		)
-	elif op in MATH_ONE_INPUT:
+	kind, size, name = MATH_OPERATIONS.get(op, (None, 0, None))
+	if kind == MATH_KIND_NODE:
 		exp = exp_generic(
-			name=MATH_ONE_INPUT[op],
-			inputs=node.inputs[:1],
+			name=name,
+			inputs=node.inputs[:size],
 			exp_list=exp_list,
 			force_default=True,
 		)
-	elif op in MATH_CUSTOM_FUNCTIONS:
-		size, path = MATH_CUSTOM_FUNCTIONS[op]
+	elif kind == MATH_KIND_FUNCTION:
 		exp = exp_function_call(
-			path,
+			name,
 			inputs=node.inputs[:size],
 			exp_list=exp_list,
 		)
-	elif op in MATH_CUSTOM_IMPL:
+	elif kind == MATH_KIND_CUSTOM:
 		in_0 = get_expression(node.inputs[0], exp_list)
 		n = None
 		if op == "RADIANS":
@@ -2407,6 +2702,8 @@ def exp_math(socket, exp_list):
 		else:
 			# these use two inputs
 			in_1 = get_expression(node.inputs[1], exp_list)
+			value_0 = get_scalar_constant(in_0)
+			value_1 = get_scalar_constant(in_1)
 			if op == "LOGARITHM":  # take two logarithms and divide
 				log0 = Node("Logarithm2")
 				log0.push(exp_input("0", in_0))
@@ -2417,6 +2714,15 @@ def exp_math(socket, exp_list):
 				n = Node("Divide")
 				n.push(exp_input("0", {"expression": exp_0}))
 				n.push(exp_input("1", {"expression": exp_1}))
+			elif op in ("LESS_THAN", "GREATER_THAN") and value_0 is not None and value_1 is not None:
+				# compare constants here, following the If nodes written below
+				# where values within the If default threshold are equal
+				difference = value_0 - value_1
+				if abs(difference) <= IF_EQUALS_THRESHOLD:
+					result = op == "LESS_THAN"
+				else:
+					result = (difference > 0) == (op == "GREATER_THAN")
+				exp = {"expression": exp_scalar(1.0 if result else 0.0, exp_list)}
 			elif op == "LESS_THAN":
 				n = Node("If")
 				one = {"expression": exp_scalar(1.0, exp_list)}
@@ -2435,15 +2741,14 @@ def exp_math(socket, exp_list):
 				n.push(exp_input("2", one))  # A > B
 				n.push(exp_input("3", zero))  # A == B
 				n.push(exp_input("4", zero))  # A < B
-		assert n
-		exp = {"expression": exp_list.push(n)}
+		if not exp:
+			assert n
+			exp = {"expression": exp_list.push(n)}
 
 	assert exp, "unrecognized math operation: %s" % op
 
 	if getattr(node, "use_clamp", False):
-		clamp = Node("Saturate")
-		clamp.push(exp_input("0", exp))
-		exp = {"expression": exp_list.push(clamp)}
+		exp = {"expression": exp_saturate(exp, exp_list)}
 	return exp
 
 
@@ -2560,9 +2865,7 @@ def exp_mix(socket, exp_list):
 	if node.clamp_factor:
 		# possible optimization:
 		# if in_factor is constant, do static check?
-		clamp = Node("Saturate")
-		push_exp_input(clamp, "0", in_factor)
-		in_factor = exp_list.push(clamp)
+		in_factor = exp_saturate(in_factor, exp_list)
 
 	if data_type == "FLOAT":
 		in_a = get_expression(inputs[EXP_MIX_A_SCALAR], exp_list)
@@ -2586,19 +2889,27 @@ def exp_mix(socket, exp_list):
 		push_exp_input(result, 0, in_a)
 		push_exp_input(result, 1, in_b)
 		push_exp_input(result, 2, in_factor)
+		result_exp = exp_list.push(result)
 	else:
 		assert data_type == "RGBA"
-		result = Node("FunctionCall", {"Function": op_map_blend[node.blend_type]})
-		push_exp_input(result, 0, in_factor)
-		push_exp_input(result, 1, in_a)
-		push_exp_input(result, 2, in_b)
-
-	result_exp = exp_list.push(result)
+		result_exp = exp_cached_function_call(op_map_blend[node.blend_type], get_exp_inputs((in_factor, in_a, in_b)), exp_list)
 
-	if data_type == "RGBA":
 		if node.clamp_result:
-			clamp = Node("Saturate")
-			push_exp_input(clamp, "0", result_exp)
-			result_exp = exp_list.push(clamp)
+			result_exp = exp_saturate(result_exp, exp_list)
 
 	return result_exp
+
+
+# function paths end up as attribute values of many nodes, interning them
+# makes every node share the same string object instead of equal copies
+def intern_function_paths():
+	module_globals = globals()
+	for name, value in list(module_globals.items()):
+		if name.startswith("MAT_FUNC_") and type(value) is str:
+			module_globals[name] = sys.intern(value)
+	for function_map in (op_custom_functions, op_map_blend, TEX_GRADIENT_NODE_MAP, NODE_COMBINE_COLOR_MAP, NODE_SEPARATE_COLOR_MAP, MAT_FUNC_MAPPINGS):
+		for key, value in function_map.items():
+			function_map[key] = sys.intern(value)
+
+
+intern_function_paths()
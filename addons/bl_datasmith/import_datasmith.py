@@ -3,15 +3,25 @@
 # SPDX-FileName: import_datasmith.py
 
 import bpy
+import sys
 import time
 import struct
 
+from array import array
 from os import path
-from mathutils import Matrix, Quaternion
+from mathutils import Matrix
 
 import logging
 import numpy as np
-import xml.etree.ElementTree as ET
+
+try:
+	from lxml import etree as ET
+
+	USE_LXML = True
+except ImportError:
+	import xml.etree.ElementTree as ET
+
+	USE_LXML = False
 
 log = logging.getLogger("bl_datasmith")
 
@@ -30,7 +40,7 @@ matrix_forward_inv = matrix_forward.inverted()
 
 def handle_transform(node, iter):
 	def p(x):
-		float(node.attrib[x])
+		return float(node.attrib[x])
 
 	loc = (p("tx"), p("ty"), p("tz"))
 	rot = (p("qw"), p("qx"), p("qy"), p("qz"))
@@ -47,7 +57,7 @@ def unhandled(_ctx, node, iter):
 	# if node.tag == "material":
 	# import pdb
 	# pdb.set_trace()
-	log.debug("<%s UNHANDLED>" % node.tag)
+	log.debug("<%s UNHANDLED>", node.tag)
 	for action, child in iter:
 		if child == node:
 			assert action == "end"
@@ -64,6 +74,17 @@ def ignore(_ctx, node, iter):
 	log.error("never got end event")
 
 
+# frees an element that has been fully processed, so the parsed tree doesn't
+# keep growing with the whole file contents
+def release_element(parent, element):
+	element.clear()
+	if USE_LXML:
+		while element.getprevious() is not None:
+			del parent[0]
+	else:
+		parent.remove(element)
+
+
 def handle_actor_children(target, node, iter):
 	# strangely, an actor 'visible' flag is in its children node
 	# visible_str = node.attrib["visible"]
@@ -76,6 +97,7 @@ def handle_actor_children(target, node, iter):
 		actor_child = handle_actor_common(None, child, iter)
 		assert actor_child is not None
 		target["children"].append(actor_child)
+		release_element(node, child)
 
 	assert child == node
 	assert action == "end"
@@ -135,25 +157,24 @@ def fill_keyvalueproperty(target, node, iter):
 
 	parser = parse_kvp.get(prop_type)
 	if parser is None:
-		log.error(f"unable to find parser for {prop_type}")
+		log.error("unable to find parser for %s", prop_type)
 	assert parser is not None
 	target[prop_name] = parser(node.attrib["val"])
 
 
+# actor transforms are stored contiguously as rows of
+# (tx, ty, tz, qw, qx, qy, qz, sx, sy, sz), actors keep their row index
+transform_attrs = ("tx", "ty", "tz", "qw", "qx", "qy", "qz", "sx", "sy", "sz")
+transform_stride = len(transform_attrs)
+transform_buffer = array("d")
+
+
 def fill_transform(target, node, iter):
 	check_close(node, iter)
 
 	attr = node.attrib
-
-	def p(x):
-		float(attr[x])
-
-	# we manually set the Y coordinate to negative
-	loc = (p("tx"), p("ty"), p("tz"))
-	rot = (p("qw"), p("qx"), p("qy"), p("qz"))
-	scale = (p("sx"), p("sy"), p("sz"))
-
-	target["transform"] = (loc, rot, scale)
+	target["transform_idx"] = len(transform_buffer) // transform_stride
+	transform_buffer.extend([float(attr[name]) for name in transform_attrs])
 
 
 def fill_actor_mesh(target, node, iter):
@@ -221,16 +242,16 @@ def handle_actor_common(target, node, iter):
 	}
 	if node_type == "Light":
 		actor["light_type"] = node.attrib["type"]
-	filler_map = actor_maps.get(node_type, {})
+	filler_map_get = actor_maps.get(node_type, {}).get
 	for action, child in iter:
 		if action == "end":
 			break
-		handler = filler_map.get(child.tag, unhandled)
-		handler(actor, child, iter)
+		filler_map_get(child.tag, unhandled)(actor, child, iter)
+		release_element(node, child)
 	assert child == node
 	assert action == "end"
 
-	log.debug(f"{node_type}: {actor_name}")
+	log.debug("%s: %s", node_type, actor_name)
 	return actor
 
 
@@ -363,14 +384,26 @@ def load_udsmesh_file(mesh):
 		mesh["normals"] = normals
 
 		# WedgeTexCoords
-		all_uvs = []
+		# all non-empty channels are packed in a single buffer, and we keep
+		# (offset, length) spans to slice each channel from it
+		uv_chunks = []
+		uv_spans = []
+		uvs_length = 0
 		for uv_idx in range(8):
 			num_uvs = unpack_from_file(4, "<I", f)[0]
-			uvs_base = np.frombuffer(f.read(num_uvs * 4 * 2), dtype=np.float32)
-			uvs = (uvs_base.reshape((-1, 2)) * np.array((1, -1))).reshape((-1,))
-			all_uvs.append(uvs)
+			if num_uvs == 0:
+				continue
+			uv_chunks.append(f.read(num_uvs * 4 * 2))
+			uv_spans.append((uvs_length, num_uvs * 2))
+			uvs_length += num_uvs * 2
+
+		uvs_buffer = np.empty(uvs_length, dtype=np.float32)
+		for uv_chunk, (uv_offset, uv_length) in zip(uv_chunks, uv_spans):
+			uvs_buffer[uv_offset : uv_offset + uv_length] = np.frombuffer(uv_chunk, dtype=np.float32)
+		uvs_buffer[1::2] *= -1
 
-		mesh["uvs"] = all_uvs
+		mesh["uvs"] = uvs_buffer
+		mesh["uv_spans"] = uv_spans
 
 		# WedgeColors
 		num_vertex_colors = unpack_from_file(4, "<I", f)[0]
@@ -400,12 +433,12 @@ def handle_texture(uscene, node, iter):
 	texture_name = node.attrib["name"]
 	# <Texture name="Metal_Corrogated_Shiny" texturemode="0" texturefilter="3" textureaddressx="0" textureaddressy="0" rgbcurve="-1.000000" file="APTO V3_Assets/Metal_Corrogated_Shiny.jpg">
 	path = node.attrib["file"]
-	log.info("loading texture: %s" % path)
+	log.info("loading texture: %s", path)
 	filename_start = path.find("/")
 	if filename_start == -1:
 		filename_start = path.find("\\")
 	if filename_start == -1:
-		log.error("unable to find path separators in path: %s" % path)
+		log.error("unable to find path separators in path: %s", path)
 
 	filename = path[filename_start + 1 :]
 	texture = {"name": texture_name, "filename": filename, "path": path, "mode": node.attrib.get("texturemode")}
@@ -504,12 +537,22 @@ def handle_pbrmaterial_input(material, node, iter):
 	handle_material_input(mat_inputs, node, iter)
 
 
+# many expressions share the same KeyValueProperty values (like Float 0.5)
+# so we reuse the same tuple for all of them instead of allocating new ones
+prop_data_cache = {}
+
+
+def get_prop_data(prop_type, prop_value):
+	prop_data = (prop_type, prop_value)
+	return prop_data_cache.setdefault(prop_data, prop_data)
+
+
 def handle_pbrmat_exp_generic(node: ET.Element, iter):
 	material_inputs = {}
 	material_props = {}
 	for action, input_node in iter:
 		if action == "end":
-			log.info("ending %s" % node.tag)
+			log.info("ending %s", node.tag)
 			assert input_node == node
 			break
 		node_tag = input_node.tag
@@ -521,19 +564,18 @@ def handle_pbrmat_exp_generic(node: ET.Element, iter):
 		elif node_tag == "KeyValueProperty":
 			check_close(input_node, iter)
 			attrs = input_node.attrib
-			prop_data = (attrs["type"], attrs["val"])
-			name = attrs["name"]
-			material_props[name] = prop_data
+			material_props[sys.intern(attrs["name"])] = get_prop_data(attrs["type"], attrs["val"])
 		else:
-			log.warning("expression has unrecognized param: %s" % node_tag)
+			log.warning("expression has unrecognized param: %s", node_tag)
 
-	expression_data = (node.tag, node.attrib, material_inputs, material_props)
+	# copy attribs as elements get cleared after being processed
+	expression_data = (node.tag, dict(node.attrib), material_inputs, material_props)
 	return expression_data
 
 
 def handle_pbrmat_exp_textureobject(node: ET.Element, iter):
 	action, child = next(iter)
-	attrib = child.attrib
+	attrib = dict(child.attrib)
 	# tex_name = child.attrib["name"]
 	# tex_val = child.attrib["val"]
 	check_close(child, iter)
@@ -545,7 +587,7 @@ def handle_pbrmaterial_expressions(material, node, iter):
 	expressions = material["expressions"] = []
 	for action, exp_node in iter:
 		if action == "end":
-			log.info("ending %s" % exp_node.tag)
+			log.info("ending %s", exp_node.tag)
 			assert exp_node == node
 			break
 
@@ -557,6 +599,7 @@ def handle_pbrmaterial_expressions(material, node, iter):
 		else:
 			expression_data = handle_pbrmat_exp_generic(exp_node, iter)
 		expressions.append(expression_data)
+		release_element(node, exp_node)
 
 
 def handle_pbrmaterial_value(material, node, iter):
@@ -566,29 +609,32 @@ def handle_pbrmaterial_value(material, node, iter):
 	material[key] = value
 
 
+pbrmaterial_filler_map = {
+	"Input": handle_pbrmaterial_input,
+	"Expressions": handle_pbrmaterial_expressions,
+	"OpacityMaskClipValue": unhandled,
+	"ShadingModel": handle_pbrmaterial_value,
+	"BaseColor": handle_pbrmaterial_input,
+	"Roughness": handle_pbrmaterial_input,
+	"Metallic": handle_pbrmaterial_input,
+	"Normal": handle_pbrmaterial_input,
+}
+
+
 def handle_pbrmaterial(uscene, node, iter):
 	material_name = node.attrib["name"]  # see also: label
 	material = {"name": material_name, "type": node.tag, "inputs": {}}
 	# <MasterMaterial name="Default-G7a1920d61156abc05a60135aefe8bc67"  label="Default" Type="1" Quality="0" >
-	log.info("reading pbrmaterial %s" % material_name)
+	log.info("reading pbrmaterial %s", material_name)
+	filler_map_get = pbrmaterial_filler_map.get
 	for action, child in iter:
 		if action == "end":
 			assert child == node
 			break
 		child_tag = child.tag
-		filler_map = {
-			"Input": handle_pbrmaterial_input,
-			"Expressions": handle_pbrmaterial_expressions,
-			"OpacityMaskClipValue": unhandled,
-			"ShadingModel": handle_pbrmaterial_value,
-			"BaseColor": handle_pbrmaterial_input,
-			"Roughness": handle_pbrmaterial_input,
-			"Metallic": handle_pbrmaterial_input,
-			"Normal": handle_pbrmaterial_input,
-		}
-		handler = filler_map.get(child_tag, unhandled)
+		handler = filler_map_get(child_tag, unhandled)
 		if handler == unhandled:
-			log.error("pbrmaterial unhandled tag: %s" % child_tag)
+			log.error("pbrmaterial unhandled tag: %s", child_tag)
 
 		handler(material, child, iter)
 
@@ -618,12 +664,12 @@ def handle_staticmesh(uscene, node, xml_iter):
 		# maybe we can use this hash to skip model importing.
 		"Hash": ignore,
 	}
+	filler_map_get = filler_map.get
 	for action, child in xml_iter:
 		if action == "end":
 			assert child == node
 			break
-		handler = filler_map.get(child.tag, unhandled)
-		handler(mesh, child, xml_iter)
+		filler_map_get(child.tag, unhandled)(mesh, child, xml_iter)
 	assert child == node
 	assert action == "end"
 
@@ -666,12 +712,10 @@ def handle_staticmesh(uscene, node, xml_iter):
 	bl_mesh.polygons.foreach_set("loop_total", [3] * num_tris)
 	bl_mesh.polygons.foreach_set("vertices", indices)
 
-	mesh_uvs = mesh["uvs"]
-	for uv_set in mesh_uvs:
-		if len(uv_set) == 0:
-			continue
+	uvs_buffer = mesh["uvs"]
+	for uv_offset, uv_length in mesh["uv_spans"]:
 		uv_layer = bl_mesh.uv_layers.new()
-		uv_layer.data.foreach_set("uv", uv_set)
+		uv_layer.data.foreach_set("uv", uvs_buffer[uv_offset : uv_offset + uv_length])
 
 	normals = mesh["normals"]
 
@@ -689,7 +733,12 @@ def handle_staticmesh(uscene, node, xml_iter):
 	bl_mesh.normals_split_custom_set(tuple(zip(*(iter(fixed_nors.data),) * 3)))
 
 	mesh["bl_mesh"] = bl_mesh
-	log.debug(f"mesh: {mesh['name']}")
+
+	# raw buffers are not needed anymore once the blender mesh exists
+	for key in ("material_indices", "smoothing_groups", "vertices", "indices", "normals", "uvs", "uv_spans", "vertex_colors"):
+		del mesh[key]
+
+	log.debug("mesh: %s", mesh["name"])
 	uscene["meshes"][mesh_name] = mesh
 
 	return mesh
@@ -712,7 +761,7 @@ def handle_root_tag(uscene, node, iter):
 	}
 
 	handler = root_tags.get(node.tag, unhandled)
-	log.debug("handling root tag: %s" % node.tag)
+	log.debug("handling root tag: %s", node.tag)
 	result = handler(uscene, node, iter)
 	return result
 
@@ -724,6 +773,7 @@ def handle_scene(iter, path):
 		"meshes": {},
 		"textures": {},
 		"textures_by_filename": {},
+		"pending_objects": [],
 		"path": path,
 	}
 
@@ -734,6 +784,7 @@ def handle_scene(iter, path):
 		if action == "end":
 			break
 		handle_root_tag(uscene, child, iter)
+		release_element(root, child)
 	assert child == root
 	log.info("finished parsing the xml, doing post process")
 
@@ -747,24 +798,39 @@ def handle_scene(iter, path):
 	for material in materials.values():
 		link_material(uscene, material)
 
-	log.info("linking meshes")
+	log.info("resolving mesh materials")
 	meshes = uscene["meshes"]
+	for mesh in meshes.values():
+		resolve_mesh_materials(uscene, mesh)
+
+	log.info("linking meshes")
 	for mesh in meshes.values():
 		link_mesh(uscene, mesh)
 
 	log.info("linking actors")
-	actors = uscene["actors"]
-	num_actors = len(actors)
-	processed_actors = 0
-	for actor in actors:
-		log.info("processing root actor %d/%d: %s" % (processed_actors, num_actors, actor["name"]))
-		link_actor(uscene, actor)
-		processed_actors += 1
+	link_actors(uscene, uscene["actors"])
+
+	log.info("setting actor transforms")
+	link_actor_transforms(uscene)
+
+	# objects are added to the scene after the whole hierarchy is created
+	log.info("adding objects to collection")
+	objects_link = import_ctx["master_collection"].objects.link
+	for bl_obj, _ in uscene["pending_objects"]:
+		objects_link(bl_obj)
+
+	log.info("finished scene! %s", child)
+
 
-	log.info(f"finished scene! {child}")
+# materials tend to reuse the same color constants
+color_cache = {}
 
 
 def color_from_string(color_string):
+	color = color_cache.get(color_string)
+	if color is not None:
+		return color
+
 	r = 0
 	g = 0
 	b = 0
@@ -792,7 +858,8 @@ def color_from_string(color_string):
 	cursor_end = color_string.index(")", cursor)
 	a = float(color_string[cursor:cursor_end])
 
-	return (r, g, b, a)
+	color = color_cache[color_string] = (r, g, b, a)
+	return color
 
 
 def link_texture(uscene, texture):
@@ -800,14 +867,14 @@ def link_texture(uscene, texture):
 	full_path = "%s/%s" % (uscene["path"], texture_path)
 
 	tex_name = texture["name"]
-	log.info("linking texture %s %s" % (tex_name, full_path))
+	log.info("linking texture %s %s", tex_name, full_path)
 	try:
 		image = bpy.data.images.load(full_path, check_existing=True)
 		tex_mode = texture["mode"]
 		if tex_mode == "1" or tex_mode == "3":
 			image.colorspace_settings.name = "Non-Color"
 	except Exception:
-		log.error("texture not found: %s %s" % (tex_name, full_path))
+		log.error("texture not found: %s %s", tex_name, full_path)
 		image = None
 	texture["image"] = image
 
@@ -1025,8 +1092,30 @@ pbrmaterial_node_functions = {
 }
 
 
+# maps UEPbrMaterial inputs to Principled BSDF inputs
+principled_input_map = {
+	"BaseColor": "Base Color",
+	"Roughness": "Roughness",
+	"Specular": "Specular IOR Level",
+	"Metallic": "Metallic",
+	"Normal": "Normal",
+}
+
+
+# gets the output socket that an expression input points to, as a
+# (node_idx, socket_idx) tuple. returns None if the node wasn't created
+def resolve_incoming_socket(bf_nodes, nodepath):
+	node_idx, socket_idx = nodepath
+	origin_node = bf_nodes[node_idx]
+	if not origin_node:
+		return None
+	incoming_node, _, incoming_out_sockets = origin_node
+	log.debug("    idx %d data %s", socket_idx, incoming_node)
+	return (incoming_out_sockets and incoming_out_sockets.get(socket_idx)) or incoming_node.outputs[socket_idx]
+
+
 def link_pbr_material(uscene, material):
-	log.info("processing pbr material %s" % material["name"])
+	log.info("processing pbr material %s", material["name"])
 
 	expressions = material["expressions"]
 	bf_nodes = material["bf_nodes"] = []
@@ -1036,6 +1125,8 @@ def link_pbr_material(uscene, material):
 	bl_mat = material["bl_mat"]
 	bl_mat.use_nodes = True
 	node_tree = bl_mat.node_tree
+	nodes = node_tree.nodes
+	links_new = node_tree.links.new
 
 	for exp in expressions:
 		exp_type, exp_attrs, exp_inputs, exp_props = exp
@@ -1048,7 +1139,7 @@ def link_pbr_material(uscene, material):
 			data = handler(uscene, exp, node_tree)
 			bf_node = (data["node"], data.get("inputs"), data.get("outputs"))
 		else:
-			log.error("  exp_type not supported: %s" % exp_type)
+			log.error("  exp_type not supported: %s", exp_type)
 			# leave bf_node as None
 
 		bf_nodes.append(bf_node)
@@ -1059,7 +1150,7 @@ def link_pbr_material(uscene, material):
 			node.name = name
 			node.label = name
 
-	log.info("linking expressions pbr material %s" % material["name"])
+	log.info("linking expressions pbr material %s", material["name"])
 
 	for exp_idx, exp in enumerate(expressions):
 		# everything prefixed with "exp" is what comes from datasmith file
@@ -1076,72 +1167,41 @@ def link_pbr_material(uscene, material):
 
 				for exp_input_id, exp_from_socket in exp_inputs.items():
 					log.debug("    input %s expr %s", exp_input_id, exp_from_socket)
-					node_idx, socket_idx = exp_from_socket
-					origin_node = bf_nodes[node_idx]
-					incoming_socket = None
-					if origin_node:
-						incoming_node, _, incoming_out_sockets = origin_node
-						log.debug("    idx %d data %s" % (socket_idx, incoming_node))
-						if incoming_out_sockets:
-							incoming_socket = incoming_out_sockets.get(socket_idx, None)
-						if incoming_socket is None:
-							incoming_socket = incoming_node.outputs[socket_idx]
-
-					if incoming_socket:
-						input_socket = node_input_map.get(exp_input_id)
-						# not guaranteed to exist:
-						# example: xml expression has 3 inputs but the node we spawned only has one
-						# common if a node isn't implemented, we use reroute
-						if input_socket:
-							node_tree.links.new(incoming_socket, input_socket)
-
-	log.info("linking outputs pbr material %s" % material["name"])
+					input_socket = node_input_map.get(exp_input_id)
+					# not guaranteed to exist:
+					# example: xml expression has 3 inputs but the node we spawned only has one
+					# common if a node isn't implemented, we use reroute
+					if input_socket:
+						incoming_socket = resolve_incoming_socket(bf_nodes, exp_from_socket)
+						if incoming_socket:
+							links_new(incoming_socket, input_socket)
+
+	log.info("linking outputs pbr material %s", material["name"])
 
 	shading_model = material.get("ShadingModel")
 	if shading_model:
 		if shading_model == "ThinTranslucent":
 			bl_mat.blend_method = "BLEND"
 		else:
-			log.error("unrecognized ShadingModel: %s" % shading_model)
+			log.error("unrecognized ShadingModel: %s", shading_model)
 
 	# after dealing with expressions, set inputs to master node
-	principled = node_tree.nodes["Principled BSDF"]
+	principled = nodes["Principled BSDF"]
+	principled_inputs = principled.inputs
+	principled_sockets = {input_id: principled_inputs.get(input_name) for input_id, input_name in principled_input_map.items()}
 	material_inputs = material["inputs"]
 	for input_id, input_nodepath in material_inputs.items():
-		input_id_map = {
-			"BaseColor": "Base Color",
-			"Roughness": "Roughness",
-			"Specular": "Specular IOR Level",
-			"Metallic": "Metallic",
-			"Normal": "Normal",
-		}
-		target_input_name = input_id_map.get(input_id, None)
-		if target_input_name:
-			node_idx, socket_idx = input_nodepath
-			input_socket = principled.inputs[target_input_name]
-
-			if True:
-				origin_node = bf_nodes[node_idx]
-				incoming_socket = None
-				if origin_node:
-					incoming_node, _, incoming_out_sockets = origin_node
-					log.info("idx %d data %s" % (socket_idx, incoming_node))
-					if incoming_out_sockets:
-						incoming_socket = incoming_out_sockets.get(socket_idx, None)
-					if incoming_socket is None:
-						incoming_socket = incoming_node.outputs[socket_idx]
-
-				if incoming_socket:
-					# input_socket = node_input_map.get(exp_input_id)
-					node_tree.links.new(incoming_socket, input_socket)
-
-			# from_socket = from_node.outputs[from_socket_idx]
-			# node_tree.links.new(from_socket, input_socket)
+		input_socket = principled_sockets.get(input_id)
+		if input_socket is None:
+			continue
+		incoming_socket = resolve_incoming_socket(bf_nodes, input_nodepath)
+		if incoming_socket:
+			links_new(incoming_socket, input_socket)
 
 
 def link_material(uscene, material):
 	material_name = material["name"]
-	log.info("linking material: %s" % material_name)
+	log.info("linking material: %s", material_name)
 	bl_mat = bpy.data.materials.new(material_name)
 	material["bl_mat"] = bl_mat
 
@@ -1167,7 +1227,7 @@ def link_material(uscene, material):
 		texture_prop = material.get("Texture")
 		if texture_prop:
 			texture = uscene["textures_by_filename"][texture_prop]
-			log.error(repr(texture))
+			log.debug("texture: %r", texture)
 			image = texture["image"]
 			bl_mat.use_nodes = True
 			node_tree = bl_mat.node_tree
@@ -1178,21 +1238,31 @@ def link_material(uscene, material):
 			image_node.image = image
 
 
-def link_mesh(uscene, mesh):
-	mesh_name = mesh["name"]
-	log.info("linking mesh:%s" % mesh_name)
-	bl_mesh = mesh["bl_mesh"]
-	mesh_mats = bl_mesh.materials
-	material_ids = mesh["materials"]
+# stores the blender material in each mesh material entry, so they become
+# (mat_id, mat_name, bl_mat), bl_mat being None if the material wasn't found
+def resolve_mesh_materials(uscene, mesh):
 	scene_mats = uscene["materials"]
-	for idx, mat_data in enumerate(material_ids):
+	resolved_materials = []
+	for mat_data in mesh["materials"]:
 		if mat_data:
 			mat_id, mat_name = mat_data
-			log.debug("mesh %s mat %s" % (mesh_name, mat_name))
-			mat_data2 = scene_mats.get(mat_name)
-			if mat_data2:
-				material = mat_data2["bl_mat"]
-				mesh_mats[idx] = material
+			scene_mat = scene_mats.get(mat_name)
+			bl_mat = scene_mat["bl_mat"] if scene_mat else None
+			mat_data = (mat_id, mat_name, bl_mat)
+		resolved_materials.append(mat_data)
+	mesh["materials"] = resolved_materials
+
+
+def link_mesh(uscene, mesh):
+	mesh_name = mesh["name"]
+	log.info("linking mesh:%s", mesh_name)
+	mesh_mats = mesh["bl_mesh"].materials
+	for idx, mat_data in enumerate(mesh["materials"]):
+		if mat_data:
+			log.debug("mesh %s mat %s", mesh_name, mat_data[1])
+			bl_mat = mat_data[2]
+			if bl_mat:
+				mesh_mats[idx] = bl_mat
 
 
 datasmith_transform_matrix = Matrix.Scale(0.01, 4)
@@ -1201,67 +1271,150 @@ datasmith_transform_matrix[1][1] *= -1.0
 ue_transform_mat = datasmith_transform_matrix
 ue_transform_mat_inv = ue_transform_mat.inverted()
 
-
-def link_actor(uscene, actor, in_parent=None):
-	actor_name = actor["name"]
-	log.debug("linking actor %s" % actor_name)
-	data = None
-	actor_type = actor["type"]
-	if actor_type == "ActorMesh":
-		mesh_name = actor["mesh"]
-		data = uscene["meshes"][mesh_name]["bl_mesh"]
-	elif actor_type == "Light":
-		light_type_map = {
-			"PointLight": "POINT",
-			"AreaLight": "AREA",
-			"DirectionalLight": "SUN",
-			"SpotLight": "SPOT",
-		}
-		light_type = light_type_map[actor["light_type"]]
-		data = bpy.data.lights.new(actor_name, light_type)
-
-		data.color = actor["color"]
-		data.energy = 12.5 * float(actor["Intensity"])
-
-	elif actor_type == "Camera":
-		data = bpy.data.cameras.new(actor_name)
-
-	bl_obj = bpy.data.objects.new(actor_name, data)
-	bl_obj.parent = in_parent
-
-	# import pdb; pdb.set_trace()
-
-	loc, rot, scale = actor["transform"]
-	# log.debug(f"postprocessing {actor_name} {transform}")
-	mat_loc = Matrix.Translation(np.array(loc))
-	mat_rot = Quaternion(rot).to_matrix()
-	mat_sca = Matrix.Diagonal(scale)
-	mat_out = mat_loc.to_4x4() @ mat_rot.to_4x4() @ mat_sca.to_4x4()
-
+# as both ue_transform matrices are diagonal, `ue @ m @ ue_inv` just scales
+# each element of m as m[i][j] * ue[i][i] * ue_inv[j][j], this flips the
+# Y row and column and scales the translation
+ue_conjugate_factors = np.outer(np.diag(ue_transform_mat), np.diag(ue_transform_mat_inv))
+
+# cameras and lights also need `@ matrix_forward_inv`, which only reorders and
+# negates columns, so it folds with the conversion into a column gather and
+# a different set of factors: column j comes from column forward_columns[j]
+matrix_forward_inv_np = np.array(matrix_forward_inv)
+forward_columns = np.abs(matrix_forward_inv_np).argmax(axis=0)
+forward_factors = ue_conjugate_factors[:, forward_columns] * matrix_forward_inv_np[forward_columns, np.arange(4)]
+
+
+# fills `out` (N, 3, 3) with the rotation matrices of N unit quaternions in (w, x, y, z) order
+def quats_to_mat3(quats, out):
+	w, x, y, z = quats.T
+	x2 = x + x
+	y2 = y + y
+	z2 = z + z
+	xx = x * x2
+	yy = y * y2
+	zz = z * z2
+	xy = x * y2
+	xz = x * z2
+	yz = y * z2
+	wx = w * x2
+	wy = w * y2
+	wz = w * z2
+
+	out[:, 0, 0] = 1 - (yy + zz)
+	out[:, 0, 1] = xy - wz
+	out[:, 0, 2] = xz + wy
+	out[:, 1, 0] = xy + wz
+	out[:, 1, 1] = 1 - (xx + zz)
+	out[:, 1, 2] = yz - wx
+	out[:, 2, 0] = xz - wy
+	out[:, 2, 1] = yz + wx
+	out[:, 2, 2] = 1 - (xx + yy)
+	return out
+
+
+# composes translation @ rotation @ scale for many transforms at once
+def compose_transforms(locs, quats, scales):
+	matrices = np.zeros((len(locs), 4, 4))
+	rotations = quats_to_mat3(quats, matrices[:, :3, :3])
+	rotations *= scales[:, np.newaxis, :]
+	matrices[:, :3, 3] = locs
+	matrices[:, 3, 3] = 1
+	return matrices
+
+
+def link_actor_transforms(uscene):
+	pending_objects = uscene["pending_objects"]
+	transform_indices = np.array([actor["transform_idx"] for _, actor in pending_objects], dtype=np.intp)
+	transforms = np.frombuffer(transform_buffer, dtype=np.float64).reshape((-1, transform_stride))[transform_indices]
+	locs = transforms[:, 0:3]
+	quats = transforms[:, 3:7]
+	scales = transforms[:, 7:10]
+	matrices = compose_transforms(locs, quats, scales)
+
+	# convert from UE space
 	# TODO: be able to mirror Y-axis from the mesh, so we don't end up with
 	# a bunch of -1s in scale and a 180 rotation
-	# mat_out = datasmith_transform_matrix @ mat_out
-	# mat_out = mat_out @ matrix_datasmith.inverted()
-	mat_out = ue_transform_mat @ mat_out @ ue_transform_mat_inv
+	use_forward = np.array([actor["type"] in ("Camera", "Light") for _, actor in pending_objects], dtype=bool)
+	matrices[~use_forward] *= ue_conjugate_factors
+	matrices[use_forward] = matrices[use_forward][:, :, forward_columns] * forward_factors
 
-	if actor_type == "Camera" or actor_type == "Light":
-		mat_out = mat_out @ matrix_forward_inv
+	# objects are in the same order as the hierarchy was created, so
+	# parents get their matrix before their children
+	for (bl_obj, _), matrix in zip(pending_objects, matrices):
+		bl_obj.matrix_world = Matrix(matrix)
 
-	bl_obj.matrix_world = mat_out
-	master_collection = bpy.data.collections[0]
-	master_collection.objects.link(bl_obj)
 
-	children = actor["children"]
-	for child in children:
-		link_actor(uscene, child, bl_obj)
+light_type_map = {
+	"PointLight": "POINT",
+	"AreaLight": "AREA",
+	"DirectionalLight": "SUN",
+	"SpotLight": "SPOT",
+}
 
-	overrides = actor.get("material_overrides", None)
-	if overrides:
-		for slot_idx, mat_name in overrides.items():
-			slot = bl_obj.material_slots[slot_idx]
-			slot.link = "OBJECT"
-			mat = uscene["materials"][mat_name]
-			slot.material = mat["bl_mat"]
+
+def link_actors(uscene, root_actors):
+	pending_objects = uscene["pending_objects"]
+	objects_new = bpy.data.objects.new
+	lights_new = bpy.data.lights.new
+	cameras_new = bpy.data.cameras.new
+	num_actors = len(root_actors)
+	processed_actors = 0
+
+	# first we walk the hierarchy and create object data, and collect what
+	# objects need to be created as (actor, data, parent_idx), so that
+	# objects can be created afterwards in a single pass.
+	# depth first, with an explicit stack so deep hierarchies don't recurse.
+	# children are pushed reversed to keep the same order as in the file
+	object_specs = []
+	stack = [(actor, None) for actor in reversed(root_actors)]
+	while stack:
+		actor, parent_idx = stack.pop()
+		actor_name = actor["name"]
+		if parent_idx is None:
+			log.info("processing root actor %d/%d: %s", processed_actors, num_actors, actor_name)
+			processed_actors += 1
+
+		log.debug("linking actor %s", actor_name)
+		data = None
+		actor_type = actor["type"]
+		if actor_type == "ActorMesh":
+			mesh_name = actor["mesh"]
+			data = uscene["meshes"][mesh_name]["bl_mesh"]
+		elif actor_type == "Light":
+			light_type = light_type_map[actor["light_type"]]
+			data = lights_new(actor_name, light_type)
+
+			data.color = actor["color"]
+			data.energy = 12.5 * float(actor["Intensity"])
+
+		elif actor_type == "Camera":
+			data = cameras_new(actor_name)
+
+		actor_idx = len(object_specs)
+		object_specs.append((actor, data, parent_idx))
+
+		children = actor["children"]
+		stack.extend((child, actor_idx) for child in reversed(children))
+
+	log.info("creating %d objects", len(object_specs))
+	first_object_idx = len(pending_objects)
+	scene_materials = uscene["materials"]
+	for actor, data, parent_idx in object_specs:
+		bl_obj = objects_new(actor["name"], data)
+		if parent_idx is not None:
+			# parents are always created before their children
+			bl_obj.parent = pending_objects[first_object_idx + parent_idx][0]
+
+		# transforms are set later for all the objects at once
+		pending_objects.append((bl_obj, actor))
+
+		overrides = actor.get("material_overrides", None)
+		if overrides:
+			for slot_idx, mat_name in overrides.items():
+				slot = bl_obj.material_slots[slot_idx]
+				slot.link = "OBJECT"
+				mat = scene_materials[mat_name]
+				slot.material = mat["bl_mat"]
 
 
 import_ctx = {}
@@ -1269,18 +1422,42 @@ import_ctx = {}
 
 def load(context, kwargs, file_path):
 	start_time = time.monotonic()
-	log.info(f"loading file: {file_path}")
-	log.info(f"args: {kwargs}")
+	log.info("loading file: %s", file_path)
+	log.info("args: %s", kwargs)
 	dir_path = path.dirname(file_path)
 	import_ctx["dir_path"] = dir_path
-	with open(file_path, encoding="utf-8") as f:
-		iter = ET.iterparse(f, events=("start", "end"))
-		handle_scene(iter, dir_path)
+	import_ctx["master_collection"] = bpy.data.collections[0]
+	# lxml only reads from binary streams, the parser takes care of decoding
+	try:
+		with open(file_path, "rb", buffering=1 << 20) as f:
+			if USE_LXML:
+				# lift lxml limits on depth and text size for big scenes
+				iter = ET.iterparse(f, events=("start", "end"), huge_tree=True)
+			else:
+				iter = ET.iterparse(f, events=("start", "end"))
+			handle_scene(iter, dir_path)
+			# drop the parser as soon as we're done, it holds on to the parsed tree
+			del iter
+	finally:
+		# also when the import fails, so nothing carries over to the next one
+		prop_data_cache.clear()
+		del transform_buffer[:]
+		color_cache.clear()
 
 	end_time = time.monotonic()
 	total_time = end_time - start_time
 
-	log.info(f"import finished in {total_time} seconds")
+	log.info("import finished in %s seconds", total_time)
+
+
+log_formatter = logging.Formatter(fmt="%(asctime)s.%(msecs)03d %(levelname)-8s %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+logging_level_map = {
+	"NEVER": logging.CRITICAL,
+	"ERROR": logging.ERROR,
+	"WARN": logging.WARNING,
+	"INFO": logging.INFO,
+	"DEBUG": logging.DEBUG,
+}
 
 
 def load_wrapper(*, context, filepath, **kwargs):
@@ -1290,23 +1467,12 @@ def load_wrapper(*, context, filepath, **kwargs):
 	if use_logging:
 		log_path = filepath + ".log"
 		handler = logging.FileHandler(log_path, mode="w")
-
-		formatter = logging.Formatter(fmt="%(asctime)s.%(msecs)03d %(levelname)-8s %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
-		handler.setFormatter(formatter)
+		handler.setFormatter(log_formatter)
 		log.addHandler(handler)
 
-		logging_level = {
-			"NEVER": logging.CRITICAL,
-			"ERROR": logging.ERROR,
-			"WARN": logging.WARNING,
-			"INFO": logging.INFO,
-			"DEBUG": logging.DEBUG,
-		}[kwargs["log_level"]]
-
-		# logging_level = logging.DEBUG
-		log.setLevel(logging_level)
-		handler.setLevel(logging_level)
-		logging.basicConfig(level=logging_level)
+		# we only configure our own logger, configuring the root logger
+		# here would add a stderr handler that stays around after import
+		log.setLevel(logging_level_map[kwargs["log_level"]])
 	try:
 		from os import path
 
@@ -1323,7 +1489,7 @@ def load_wrapper(*, context, filepath, **kwargs):
 
 	finally:
 		if use_logging:
-			log.info("Finished logging to path:" + log_path)
+			log.info("Finished logging to path: %s", log_path)
 			handler.close()
 			log.removeHandler(handler)
 